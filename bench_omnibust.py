@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""Benchmarks for omnibust on synthetic projects
+
+Generates a project with the given number of static files, code files
+and refs, then times each stage of a run separately. Results are written
+as JSON, so that runs of different versions can be compared.
+
+Usage:
+    python bench_omnibust.py [options] [--output=results.json]
+    python bench_omnibust.py [options] --compare=old_results.json
+"""
+from __future__ import print_function
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import omnibust as ob
+
+
+STATIC_EXTENSIONS = (".js", ".css", ".png", ".svg")
+DUPLICATE_NAMES = ("logo", "index", "main", "icon", "style", "app")
+FILLER = ('<div class="row"><p>Lorem ipsum dolor sit amet, consectetur '
+          'adipiscing elit.</p></div>\n')
+
+
+def mk_dirpath(rng, prefix, depth, fanout=4):
+    parts = [prefix] + ["d%d" % rng.randrange(fanout) for _ in range(depth)]
+    return "/".join(parts)
+
+
+def mk_ref(rng, static_path, style):
+    # refs are only partially qualified, so they have to be resolved
+    ref_path = "/" + "/".join(static_path.split("/")[-3:])
+    base, ext = os.path.splitext(ref_path)
+    if style == ob.FN_REF:
+        ref_path = base + "_cb_" + "abc" + ext
+    elif style == ob.QS_REF:
+        ref_path += "?_cb_=abc"
+
+    if ext == ".css":
+        return '<link rel="stylesheet" href="%s">' % ref_path
+    if ext == ".js":
+        return '<script src="%s"></script>' % ref_path
+    return '<img src="%s">' % ref_path
+
+
+def write_file(root, relpath, data):
+    path = os.path.join(root, *relpath.split("/"))
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def mk_project(root, static_files=1000, code_files=200, refs_per_file=20,
+               depth=3, duplicates=0.1, bundles=2, multibust_keys=0,
+               static_size=4096, seed=0):
+    """Write a synthetic project to root, returns its multibust config"""
+    rng = random.Random(seed)
+
+    static_paths = []
+    for i in range(static_files):
+        ext = STATIC_EXTENSIONS[i % len(STATIC_EXTENSIONS)]
+        if rng.random() < duplicates:
+            name = rng.choice(DUPLICATE_NAMES)
+        else:
+            name = "file%d" % i
+        dirpath = mk_dirpath(rng, "static", depth)
+        static_paths.append(dirpath + "/" + name + ext)
+
+    multibust = collections.OrderedDict()
+    multibust_refs = []
+    for i in range(multibust_keys):
+        key = "{{key%d}}" % i
+        values = ["v%d" % j for j in range(3)]
+        multibust[key] = values
+        for value in values:
+            static_paths.append("static/i18n/%s/msgs%d.js" % (value, i))
+        multibust_refs.append(
+            '<script src="/static/i18n/%s/msgs%d.js"></script>' % (key, i))
+
+    for path in set(static_paths):
+        if path.endswith(".png"):
+            data = os.urandom(static_size)
+        else:
+            data = "/* %s */\n" % path
+            data += "x" * max(0, static_size - len(data))
+        write_file(root, path, data)
+
+    styles = (ob.PLAIN_REF,) * 6 + (ob.QS_REF, ob.FN_REF)
+    for i in range(code_files):
+        lines = []
+        for j in range(refs_per_file):
+            lines.append(FILLER)
+            path = rng.choice(static_paths)
+            lines.append(mk_ref(rng, path, rng.choice(styles)) + "\n")
+        if multibust_refs:
+            lines.append(rng.choice(multibust_refs) + "\n")
+        dirpath = mk_dirpath(rng, "templates", depth)
+        write_file(root, "%s/page%d.html" % (dirpath, i), "".join(lines))
+
+    for i in range(bundles):
+        # minified bundles are a single long line
+        urls = ["url(/%s?_cb_=abc)" % p for p in static_paths
+                if p.endswith(".png") or p.endswith(".svg")]
+        rules = [".c%d{background:%s}" % (j, url)
+                 for j, url in enumerate(urls)]
+        write_file(root, "static/bundles/bundle%d.min.css" % i, "".join(rules))
+
+    return multibust
+
+
+class Timer(object):
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = collections.OrderedDict()
+
+    def run(self, name, fn, setup=None):
+        """Time fn, returns the result of its last call"""
+        times = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start = time.time()
+            result = fn()
+            times.append(time.time() - start)
+        self.stages[name] = {'best': min(times), 'times': times}
+        return result
+
+
+def run_stages(root, multibust, target_reftype=ob.QS_REF, repeat=3, jobs=1):
+    timer = Timer(repeat)
+    orig_cwd = os.getcwd()
+    orig_out = sys.stdout
+    copies = []
+    os.chdir(root)
+    try:
+        cfg = ob.read_cfg(["--no-init", "--jobs=%d" % jobs])
+        cfg['multibust'] = multibust
+        encoding = cfg['file_encoding']
+
+        def walk():
+            code_paths, static_paths = ob.cfg_project_paths(cfg)
+            return list(code_paths), list(static_paths)
+
+        code_paths, static_paths = timer.run('walk', walk)
+
+        def parse():
+            return list(ob.iter_refs(code_paths, True, encoding, jobs))
+
+        refs = timer.run('iter_refs', parse)
+
+        def resolve():
+            static_fn_dirs = ob.mk_fn_dir_map(static_paths)
+            return collections.OrderedDict(
+                ob.resolve_refs(refs, static_fn_dirs, multibust))
+
+        ref_map = timer.run('resolve', resolve)
+        reffed_paths = sorted(set(ob.flatten(ref_map.values())))
+
+        def mk_buster():
+            return ob.mk_buster(cfg['hash_function'], cfg['digest_length'],
+                                cfg['stat_length'])
+
+        def bust():
+            buster = mk_buster()
+            ob.prehash_paths(buster, reffed_paths, jobs)
+            return list(ob.iter_busted_refs(ref_map, target_reftype, buster))
+
+        timer.run('mk_buster', bust)
+
+        # every rewrite starts from a fresh copy of the project
+        def copy_project():
+            copy_root = os.path.join(tempfile.mkdtemp(), "project")
+            shutil.copytree(root, copy_root)
+            copies.append(copy_root)
+            os.chdir(copy_root)
+
+        def rewrite():
+            file_ref_maps = ob.group_ref_map(ref_map)
+            return ob.rewrite_codefiles(file_ref_maps, target_reftype,
+                                        mk_buster(), encoding)
+
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            rewritten = timer.run('rewrite', rewrite, setup=copy_project)
+    finally:
+        sys.stdout = orig_out
+        os.chdir(orig_cwd)
+        for copy_root in copies:
+            shutil.rmtree(os.path.dirname(copy_root), ignore_errors=True)
+
+    counts = collections.OrderedDict([
+        ('code_files', len(code_paths)),
+        ('static_files', len(static_paths)),
+        ('code_bytes', sum(os.path.getsize(os.path.join(root, p))
+                           for p in code_paths)),
+        ('refs', len(refs)),
+        ('resolved_refs', len(ref_map)),
+        ('reffed_static_files', len(reffed_paths)),
+        ('rewritten_files', len(rewritten)),
+    ])
+    return timer.stages, counts
+
+
+def run_hash_stages(root, hash_functions, repeat=3):
+    """Time digests of all static files with each hash function, and the
+    stat part of bustcodes"""
+    timer = Timer(repeat)
+    orig_cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        cfg = ob.read_cfg(["--no-init"])
+        _, static_paths = ob.cfg_project_paths(cfg)
+        static_paths = list(static_paths)
+        stats = [os.stat(p) for p in static_paths]
+
+        for hash_function in hash_functions:
+            timer.run("digest:" + hash_function, lambda: [
+                ob.digest_file(p, hash_function) for p in static_paths])
+
+        timer.run("filestat", lambda: [
+            ob.filestat(p, st) for p, st in zip(static_paths, stats)])
+        # how filestat used to mix the mtime, for reference
+        timer.run("filestat:sha1", lambda: [
+            ob.digest_data(str(st.st_mtime)) for st in stats])
+    finally:
+        os.chdir(orig_cwd)
+    return timer.stages
+
+
+def compare(results, old_results):
+    print("{0:<16}{1:>10}{2:>10}{3:>8}".format("stage", "old", "new",
+                                                "ratio"))
+    for name, stage in results['stages'].items():
+        old_stage = old_results['stages'].get(name)
+        if old_stage is None:
+            continue
+        old, new = old_stage['best'], stage['best']
+        print("{0:<16}{1:>10.4f}{2:>10.4f}{3:>8.2f}".format(
+            name, old, new, new / old if old else float('inf')))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="omnibust benchmarks")
+    parser.add_argument("--static-files", type=int, default=1000)
+    parser.add_argument("--code-files", type=int, default=200)
+    parser.add_argument("--refs-per-file", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--duplicates", type=float, default=0.1,
+                        help="fraction of static files with a common name")
+    parser.add_argument("--bundles", type=int, default=2,
+                        help="number of minified single line css files")
+    parser.add_argument("--multibust-keys", type=int, default=0)
+    parser.add_argument("--static-size", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--hash-functions",
+                        default="sha1,md5,blake2b,blake2s,crc32,adler32",
+                        help="comma separated hash functions to time, "
+                             "empty to skip")
+    parser.add_argument("--output", help="write results to a json file")
+    parser.add_argument("--compare", help="json results of an earlier run")
+    parser.add_argument("--keep", action="store_true",
+                        help="don't delete the generated project")
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    opts = parse_args(argv)
+    project_params = collections.OrderedDict([
+        ('static_files', opts.static_files),
+        ('code_files', opts.code_files),
+        ('refs_per_file', opts.refs_per_file),
+        ('depth', opts.depth),
+        ('duplicates', opts.duplicates),
+        ('bundles', opts.bundles),
+        ('multibust_keys', opts.multibust_keys),
+        ('static_size', opts.static_size),
+        ('seed', opts.seed),
+    ])
+
+    root = os.path.join(tempfile.mkdtemp(), "project")
+    try:
+        multibust = mk_project(root, **project_params)
+        stages, counts = run_stages(root, multibust, repeat=opts.repeat,
+                                    jobs=opts.jobs)
+        hash_functions = [h for h in opts.hash_functions.split(",") if h]
+        stages.update(run_hash_stages(root, hash_functions, opts.repeat))
+    finally:
+        if opts.keep:
+            print("project kept in {0}".format(root), file=sys.stderr)
+        else:
+            shutil.rmtree(os.path.dirname(root), ignore_errors=True)
+
+    results = collections.OrderedDict([
+        ('omnibust_version', ob.__version__),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('params', project_params),
+        ('jobs', opts.jobs),
+        ('counts', counts),
+        ('stages', stages),
+    ])
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    elif not opts.compare:
+        print(json.dumps(results, indent=4))
+
+    if opts.compare:
+        with open(opts.compare, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,24 @@ First steps:
     omnibust init                       # scan and write omnibust.cfg
     omnibust status                     # view updated urls
     omnibust rewrite                    # add or update cachebust params
+    omnibust watch                      # rewrite whenever files change
+    omnibust manifest                   # write busted urls to a manifest
+    omnibust publish                    # create files with busted filenames
 
 Usage:
     omnibust (--help|--version)
     omnibust init (--filename | --querystring)
-    omnibust status [--no-init] [--filename | --querystring]
-    omnibust rewrite [--no-init] [--filename | --querystring]
+    omnibust status [--no-init] [--filename | --querystring] [--jobs=N]
+                    [--git] [--stats] [--stats-json=FILE]
+    omnibust rewrite [--no-init] [--filename | --querystring] [--jobs=N]
+                    [--git] [--gzip] [--stats] [--stats-json=FILE]
+                    [--manifest=FILE]
+    omnibust watch [--no-init] [--filename | --querystring] [--jobs=N]
+                    [--git]
+    omnibust manifest [--no-init] [--manifest=FILE] [--jobs=N]
+                    [--git] [--stats] [--stats-json=FILE]
+    omnibust publish [--no-init] [--publish-dir=DIR] [--jobs=N]
+                    [--git] [--gzip] [--stats] [--stats-json=FILE]
 
 Options:
     -h --help           Display this message
@@ -30,20 +42,44 @@ Options:
                             contains a cachebust parameter.
     --filename          Rewrites all references so the filename
                             contains a cachebust parameter.
+    --jobs=N            Number of worker processes to parse code files
+                            and threads to hash static files.
+    --git               List files with git instead of walking the project
+                            directory, and bust files which are unchanged
+                            since checkout by their git blob id.
+    --stats             Print time spent per stage and counters of files,
+                            bytes and refs.
+    --stats-json=FILE   Write the same statistics as json to FILE.
+    --manifest=FILE     Path of the manifest, overrides "manifest_file"
+                            of omnibust.cfg. Other commands don't scan
+                            this file either.
+    --publish-dir=DIR   Create busted filenames in DIR instead of next to
+                            the static files.
+    --gzip              Write .gz files next to referenced (or published)
+                            js, css and svg files, for gzip_static.
 """
 from __future__ import print_function
-import time
 import base64
+import bisect
 import codecs
 import collections
+import contextlib
 import fnmatch
 import hashlib
+import itertools
 import json
 import os
 import re
+import select
+import shutil
 import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import zlib
+from multiprocessing.pool import ThreadPool
 
 
 PY2 = sys.version_info[0] == 2
@@ -53,21 +89,27 @@ if PY2:
     range = xrange
 else:
     unicode = str
+    unichr = chr
 
 
 class BaseError(Exception):
-    pass
+    def __init__(self, message):
+        # exceptions of python 3 don't have a message attribute
+        Exception.__init__(self, message)
+        self.message = message
 
 
 class PathError(BaseError):
     def __init__(self, message, path):
+        BaseError.__init__(self, message)
         self.path = path
-        self.message = message
 
 
 Ref = collections.namedtuple('Ref', (
-    "code_dir", "code_fn", "lineno", "full_ref", "path", "bustcode", "type"
+    "code_dir", "code_fn", "lineno", "full_ref", "path", "bustcode", "type",
+    "offset"    # of full_ref in the decoded codefile content
 ))
+Ref.__new__.__defaults__ = (None,)
 
 
 # util functions
@@ -111,63 +153,243 @@ def b32enc(val):
     return b32val.decode('ascii').replace("=", "").lower()
 
 
+class Checksum(object):
+    """hashlib style interface to the checksums of zlib"""
+
+    FUNCS = {'crc32': (zlib.crc32, 0), 'adler32': (zlib.adler32, 1)}
+
+    __slots__ = ('func', 'value')
+
+    def __init__(self, name='crc32'):
+        self.func, self.value = self.FUNCS.get(name, self.FUNCS['crc32'])
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def digest(self):
+        return self.value
+
+
+BLAKE2_FUNCS = ('blake2b', 'blake2s')
+
+
+def new_hasher(digester_name='sha1'):
+    """Hash object for a hash_function of the config.
+
+    Besides the hashes of hashlib, these are the checksums crc32 and
+    adler32, and blake2b/blake2s with an optional digest size in bytes,
+    such as "blake2b:16". Other unknown names fall back to crc32, but a
+    blake2 function is never replaced by another hash.
+    """
+    name, sep, digest_size = digester_name.partition(":")
+    if name in BLAKE2_FUNCS:
+        if not hasattr(hashlib, name):
+            raise BaseError("hash_function '{0}' requires python 3.6 or "
+                            "newer".format(digester_name))
+        if not sep:
+            return getattr(hashlib, name)()
+        try:
+            return getattr(hashlib, name)(digest_size=int(digest_size))
+        except ValueError:
+            raise BaseError("Invalid digest size in hash_function "
+                            "'{0}'".format(digester_name))
+    if sep:
+        raise BaseError("hash_function '{0}' doesn't support a digest "
+                        "size".format(digester_name))
+    if hasattr(hashlib, name):
+        return hashlib.new(name)
+    return Checksum(name)
+
+
 def digest_data(data, digester_name='sha1'):
     if isinstance(data, unicode):
         data = data.encode('utf-8')
 
-    if hasattr(hashlib, digester_name):
-        hashval = hashlib.new(digester_name, data).digest()
+    hasher = new_hasher(digester_name)
+    hasher.update(data)
+    return b32enc(hasher.digest())
+
+
+DIGEST_BUFSIZE = 64 * 1024
+
+
+def digest_file(filepath, digester_name='sha1', bufsize=DIGEST_BUFSIZE):
+    """Same as digest_data(open(filepath).read()), in constant memory"""
+    hasher = new_hasher(digester_name)
+    update = hasher.update
+
+    buf = bytearray(bufsize)
+    if PY2:
+        # zlib of python 2 doesn't accept memoryviews
+        chunk = lambda n: buffer(buf, 0, n)
     else:
-        hashval = zlib.crc32(data)
-    return b32enc(hashval)
+        chunk = lambda n, view=memoryview(buf): view[:n]
+    with open(filepath, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            update(chunk(n))
+
+    return b32enc(hasher.digest())
 
 
-def filestat(filepath):
-    # digesting ensures any change in the file modification
-    # time is reflected in all/most of the returned bytes
-    return digest_data(unicode(os.path.getmtime(filepath)))
+MASK64 = 0xFFFFFFFFFFFFFFFF
 
 
-def mk_buster(digest_func, digest_len=3, stat_len=3):
+def mix64(val):
+    """Finalizer of splitmix64, each input bit affects all output bits"""
+    val = ((val ^ (val >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    val = ((val ^ (val >> 27)) * 0x94D049BB133111EB) & MASK64
+    return val ^ (val >> 31)
+
+
+def filestat(filepath, st=None, length=13):
+    if st is None:
+        st = os.stat(filepath)
+    # mixing ensures any change in the file modification time is
+    # reflected in all of the returned characters, 13 per mixed word
+    seed = mtime_ns(st)
+    if length <= 13:
+        return b32enc(struct.pack("<Q", mix64(seed & MASK64)))[:length]
+
+    nwords = (length + 12) // 13
+    words = [mix64((seed + i * 0x9E3779B97F4A7C15) & MASK64)
+             for i in range(nwords)]
+    return b32enc(struct.pack("<%dQ" % nwords, *words))[:length]
+
+
+def mtime_ns(st):
+    if hasattr(st, 'st_mtime_ns'):
+        return st.st_mtime_ns
+    return int(st.st_mtime * 1000000000)
+
+
+def stat_key(st):
+    """Metadata used to decide if a cached digest is still valid"""
+    return [st.st_size, mtime_ns(st), st.st_ino]
+
+
+def blob_id_bust(blob_id):
+    return b32enc(base64.b16decode(blob_id.upper()))
+
+
+def mk_buster(digest_func, digest_len=3, stat_len=3, digest_cache=None,
+              stat_cache=None, blob_ids=None):
+    """If blob_ids maps (normalized) paths to git blob ids, the bustcode
+    of these files is derived from their blob id alone, as long as they
+    are unchanged."""
+    # filepath -> (stat key, bust)
     _cache = {}
+    # sorted paths -> (busts of the paths, combined bust)
+    combined_cache = {}
+    if blob_ids is None:
+        blob_ids = {}
+    blob_keys = {}
+    if digest_cache is None:
+        digest_cache = {}
+    # filepath -> os.DirEntry (or FileEntry) from walking the project
+    if stat_cache is None:
+        stat_cache = {}
+    stats = {'hits': 0, 'misses': 0, 'bytes_hashed': 0}
+    stats_lock = threading.Lock()
+
+    def _stat(filepath):
+        entry = stat_cache.get(filepath)
+        if entry is None:
+            return os.stat(filepath)
+        return entry.stat()
+
+    def _digest(filepath, st):
+        key = stat_key(st)
+        entry = digest_cache.get(filepath)
+        hit = bool(entry) and entry[:3] == key
+        with stats_lock:
+            stats['hits' if hit else 'misses'] += 1
+            if not hit:
+                stats['bytes_hashed'] += st.st_size
+        if hit:
+            return entry[3]
+
+        digest = digest_file(filepath, digest_func)[:digest_len]
+        digest_cache[filepath] = key + [digest]
+        return digest
+
+    def _blob_bust(filepath, st):
+        path = os.path.normpath(filepath)
+        blob_id = blob_ids.get(path)
+        if blob_id is None:
+            return None
+
+        # the blob id is only valid for the file git listed
+        key = stat_key(st)
+        if blob_keys.setdefault(path, key) != key:
+            blob_ids.pop(path, None)
+            return None
+
+        with stats_lock:
+            stats['hits'] += 1
+        return blob_id_bust(blob_id)[:digest_len + stat_len]
 
     def _buster(filepath):
+        st = _stat(filepath)
+        if blob_ids:
+            bust = _blob_bust(filepath, st)
+            if bust is not None:
+                return bust
+
+        # files with an unchanged stat are neither mixed nor digested again
+        key = stat_key(st)
+        cached = _cache.get(filepath)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
         if stat_len == 0:
             stat = ""
         else:
-            stat = filestat(filepath)
-            stat = stat[:stat_len]
-
-        old_bust = _cache.get(filepath, "")
-        if stat and old_bust.endswith(stat):
-            return old_bust
+            stat = filestat(filepath, st, stat_len)
 
         if digest_len == 0:
             digest = ""
         else:
-            with open(filepath, 'rb') as f:
-                digest = digest_data(f.read(), digest_func)
-                digest = digest[:digest_len]
+            digest = _digest(filepath, st)
 
         bust = digest + stat
-        _cache[filepath] = bust
+        _cache[filepath] = (key, bust)
         return bust
 
     def _bust_paths(paths):
-        busts = (_buster(p) for p in paths)
-    
-        full_bust = ""
-    
-        for bust in busts:
-            full_bust += bust
-    
         if len(paths) == 1:
-            return full_bust
-    
-        bust_len = len(full_bust) // len(paths) 
-    
-        return digest_data(full_bust)[:bust_len]
+            return _buster(paths[0])
+
+        # the bust of several files doesn't depend on their order, and is
+        # only combined again if the bust of one of the files changed
+        key = tuple(sorted(paths))
+        busts = tuple(_buster(p) for p in key)
+        combined = combined_cache.get(key)
+        if combined is not None and combined[0] == busts:
+            return combined[1]
+
+        full_bust = "".join(busts)
+        bust_len = len(full_bust) // len(paths)
+        bust = digest_data(full_bust)[:bust_len]
+        combined_cache[key] = (busts, bust)
+        return bust
 
+    def _invalidate(paths):
+        """Forget busts of files that were changed during this run"""
+        for p in paths:
+            _cache.pop(p, None)
+            digest_cache.pop(p, None)
+            stat_cache.pop(p, None)
+            blob_ids.pop(os.path.normpath(p), None)
+
+    _bust_paths.bust_file = _buster
+    _bust_paths.invalidate = _invalidate
+    _bust_paths.digest_cache = digest_cache
+    _bust_paths.bust_cache = _cache
+    _bust_paths.stat_cache = stat_cache
+    _bust_paths.stats = stats
     return _bust_paths
 
 
@@ -176,26 +398,430 @@ def digest_paths(filepaths, digest_func):
     return digest_data(b"".join(digests))
 
 
+# persistent caches
+#
+# Cache files hold the parameters that produced their entries, entries
+# are discarded if they were produced with other parameters.
+
+BUST_CACHE_VERSION = 1
+REF_INDEX_VERSION = 3
+GZIP_INDEX_VERSION = 1
+
+
+def print_write_error(path, e):
+    print("omnibust: error writing '{0}' ('{1}')".format(path, e))
+
+
+def load_cache(cache_path, params):
+    try:
+        with codecs.open(cache_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (ValueError, IOError, OSError):
+        return {}
+
+    if not isinstance(data, dict):
+        return {}
+    for key, val in params.items():
+        if data.get(key) != val:
+            return {}
+    return data.get('files', {})
+
+
+def dump_cache(cache_path, params, entries):
+    data = dict(params, files=entries)
+    with codecs.open(cache_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(data, sort_keys=True))
+
+
+def bust_cache_params(hash_function, digest_length):
+    return {
+        'version': BUST_CACHE_VERSION,
+        'hash_function': hash_function,
+        'digest_length': digest_length,
+    }
+
+
+def load_bust_cache(cache_path, hash_function, digest_length):
+    """Load digests of a previous run, if they were made the same way"""
+    return load_cache(cache_path, bust_cache_params(hash_function,
+                                                    digest_length))
+
+
+def dump_bust_cache(cache_path, digest_cache, hash_function, digest_length):
+    dump_cache(cache_path, bust_cache_params(hash_function, digest_length),
+               digest_cache)
+
+
+def ref_index_params(parse_plain, encoding):
+    return {
+        'version': REF_INDEX_VERSION,
+        'parse_plain': parse_plain,
+        'encoding': encoding,
+    }
+
+
+class RefIndex(object):
+    """Parsed refs of codefiles, keyed by the stat key of the codefile.
+
+    The index file has a line with the params, then a line per codefile
+    with its path and stat key, a tab, and its records. Only the keys and
+    the offsets of the records are loaded, the records of an unchanged
+    codefile are read when it is walked. The new index is written to a
+    temporary file as the codefiles are walked and replaces the old one
+    on commit, so memory doesn't grow with the number of refs.
+    """
+
+    def __init__(self, index_path, params):
+        self.index_path = index_path
+        self.params = params
+        self.keys = {}      # path -> (stat key, offset of the records)
+        self._old_file = None
+        self._new_file = None
+        self._new_path = None
+        self._load()
+        self._begin()
+
+    def _load(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except (IOError, OSError):
+            return
+
+        try:
+            if json.loads(f.readline().decode('utf-8') or "null") != \
+                    self.params:
+                f.close()
+                return
+
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                # json never contains a raw tab
+                head, _, _ = line.partition(b"\t")
+                path, key = json.loads(head.decode('utf-8'))
+                self.keys[path] = (key, f.tell() - len(line) + len(head) + 1)
+        except ValueError:
+            self.keys.clear()
+            f.close()
+            return
+        self._old_file = f
+
+    def _begin(self):
+        dirname, filename = os.path.split(self.index_path)
+        try:
+            fd, self._new_path = tempfile.mkstemp(
+                prefix=filename + ".", suffix=".tmp", dir=dirname or ".")
+            self._new_file = os.fdopen(fd, 'wb')
+            self._write_line(json.dumps(self.params, sort_keys=True))
+        except (IOError, OSError) as e:
+            print_write_error(self.index_path, e)
+            self._discard()
+
+    def _write_line(self, line):
+        self._new_file.write(line.encode('utf-8') + b"\n")
+
+    def key(self, path):
+        entry = self.keys.get(path)
+        return entry and entry[0]
+
+    def records(self, path):
+        """Records of path in the previous index"""
+        self._old_file.seek(self.keys[path][1])
+        records = json.loads(self._old_file.readline().decode('utf-8'))
+        return [tuple(record) for record in records]
+
+    def add(self, path, key, records):
+        if self._new_file is None:
+            return
+        try:
+            self._write_line(json.dumps([path, key]) + "\t" +
+                             json.dumps(records))
+        except (IOError, OSError) as e:
+            print_write_error(self.index_path, e)
+            self._discard()
+
+    def _discard(self):
+        if self._new_file is not None:
+            self._new_file.close()
+            self._new_file = None
+        if self._new_path is not None:
+            try:
+                os.remove(self._new_path)
+            except OSError:
+                pass
+            self._new_path = None
+
+    def close(self, commit=False):
+        """Replace the index file with the new index if commit is True,
+        otherwise the new index is discarded"""
+        if self._old_file is not None:
+            self._old_file.close()
+            self._old_file = None
+        if not commit or self._new_file is None:
+            self._discard()
+            return
+
+        try:
+            self._new_file.close()
+            self._new_file = None
+            replace_file(self._new_path, self.index_path)
+            self._new_path = None
+        except (IOError, OSError) as e:
+            print_write_error(self.index_path, e)
+            self._discard()
+
+
+def open_cfg_ref_index(cfg, parse_plain):
+    if not cfg.get('ref_index_file'):
+        return None
+    return RefIndex(cfg['ref_index_file'],
+                    ref_index_params(parse_plain, cfg['file_encoding']))
+
+
+def gzip_index_params(level):
+    return {
+        'version': GZIP_INDEX_VERSION,
+        'gzip_level': level,
+    }
+
+
+def load_cfg_gzip_index(cfg):
+    if not cfg.get('gzip_index_file'):
+        return {}
+    return load_cache(cfg['gzip_index_file'],
+                      gzip_index_params(cfg['gzip_level']))
+
+
+def save_cfg_gzip_index(cfg, gzip_index):
+    if not cfg.get('gzip_index_file'):
+        return
+    try:
+        dump_cache(cfg['gzip_index_file'],
+                   gzip_index_params(cfg['gzip_level']), gzip_index)
+    except (IOError, OSError) as e:
+        print_write_error(cfg['gzip_index_file'], e)
+
+
+def mk_cfg_buster(cfg):
+    # fail before scanning if the hash function isn't available
+    new_hasher(cfg['hash_function'])
+    digest_cache = None
+    if cfg.get('cache_file'):
+        digest_cache = load_bust_cache(cfg['cache_file'], cfg['hash_function'],
+                                       cfg['digest_length'])
+    blob_ids = git_blob_ids(cfg.get('root')) if cfg.get('git') else None
+    return mk_buster(cfg['hash_function'], cfg['digest_length'],
+                     cfg['stat_length'], digest_cache, blob_ids=blob_ids)
+
+
+def live_digests(buster):
+    """The digests of files which were walked or busted in this run,
+    entries of deleted or renamed files are dropped"""
+    return dict((path, entry) for path, entry in buster.digest_cache.items()
+                if path in buster.stat_cache or path in buster.bust_cache)
+
+
+def save_cfg_buster(cfg, buster):
+    if not cfg.get('cache_file'):
+        return
+    try:
+        dump_bust_cache(cfg['cache_file'], live_digests(buster),
+                        cfg['hash_function'], cfg['digest_length'])
+    except (IOError, OSError) as e:
+        print_write_error(cfg['cache_file'], e)
+
+
+def print_buster_stats(buster):
+    print("omnibust: digest cache {0} hits, {1} misses".format(
+        buster.stats['hits'], buster.stats['misses']))
+
+
+def print_parse_stats(parse_stats):
+    print("omnibust: scanned {0} codefiles, skipped {1} without refs".format(
+        parse_stats['scanned'], parse_stats['skipped']))
+
+
+# run statistics
+
+class RunStats(object):
+    """Wall time per stage and counters of a run.
+
+    Time is charged to the innermost active stage. Stages which pull from
+    other stages, like parsing pulling codefile paths from the walk, are
+    reported without the time of the inner stage. Each thread has its own
+    stack of active stages: with --jobs, the task thread of the process
+    pool pulls from the walk while the main thread is parsing, and the
+    time of both is counted.
+    """
+
+    STAGES = ('walk', 'index', 'parse', 'resolve', 'hash', 'rewrite',
+              'compress')
+    COUNTERS = (
+        'code_files', 'static_files', 'scanned', 'skipped', 'bytes_read',
+        'refs_found', 'refs_resolved', 'bytes_hashed', 'cache_hits',
+        'cache_misses', 'rewrite_passes', 'files_rewritten',
+        'files_compressed',
+    )
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.timings = collections.OrderedDict(
+            (stage, 0.0) for stage in self.STAGES)
+        self.counters = collections.OrderedDict(
+            (name, 0) for name in self.COUNTERS)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _charge(self):
+        local = self._local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+        now = time.time()
+        if local.stack:
+            stage = local.stack[-1]
+            with self._lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + (
+                    now - local.mark)
+        local.mark = now
+        return local.stack
+
+    def enter(self, stage):
+        self._charge().append(stage)
+
+    def exit(self):
+        self._charge().pop()
+
+    def timed_iter(self, stage, iterable, counter=None):
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            if counter:
+                self.counters[counter] += 1
+            yield item
+
+    def add_buster(self, buster):
+        self.counters['cache_hits'] += buster.stats['hits']
+        self.counters['cache_misses'] += buster.stats['misses']
+        self.counters['bytes_hashed'] += buster.stats['bytes_hashed']
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def as_dict(self):
+        end_time = self.end_time or time.time()
+        counters = collections.OrderedDict(self.counters)
+        counters['files_walked'] = (counters['code_files'] +
+                                    counters['static_files'])
+        lookups = counters['cache_hits'] + counters['cache_misses']
+        return collections.OrderedDict([
+            ('wall_time', end_time - self.start_time),
+            ('timings', collections.OrderedDict(self.timings)),
+            ('counters', counters),
+            ('cache_hit_rate', counters['cache_hits'] / float(lookups)
+                               if lookups else None),
+        ])
+
+    def format(self):
+        data = self.as_dict()
+        lines = ["omnibust: {0:<16}{1:>10.3f}s".format(
+            "wall time", data['wall_time'])]
+        for stage, seconds in data['timings'].items():
+            lines.append("omnibust:   {0:<14}{1:>10.3f}s".format(
+                stage, seconds))
+        for name, value in data['counters'].items():
+            lines.append("omnibust: {0:<16}{1:>10}".format(
+                name.replace("_", " "), value))
+        if data['cache_hit_rate'] is not None:
+            lines.append("omnibust: {0:<16}{1:>10.1%}".format(
+                "cache hit rate", data['cache_hit_rate']))
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def stats_stage(stats, stage):
+    if stats is None:
+        yield
+        return
+
+    stats.enter(stage)
+    try:
+        yield
+    finally:
+        stats.exit()
+
+
+def stats_iter(stats, stage, iterable, counter=None):
+    if stats is None:
+        return iterable
+    return stats.timed_iter(stage, iterable, counter)
+
+
+def report_stats(args, stats):
+    stats.finish()
+    if get_flag(args, '--stats'):
+        print(stats.format())
+
+    stats_path = get_opt(args, '--stats-json', None)
+    if stats_path:
+        try:
+            with open(stats_path, 'w') as f:
+                json.dump(stats.as_dict(), f, indent=4)
+        except (IOError, OSError) as e:
+            print_write_error(stats_path, e)
+
+
+def finish_run(args, cfg, buster, stats):
+    """Save the digest cache and report the stats of a command"""
+    save_cfg_buster(cfg, buster)
+    stats.add_buster(buster)
+    if get_flag(args, '--verbose'):
+        print_parse_stats(stats.counters)
+        print_buster_stats(buster)
+    report_stats(args, stats)
+
+
 # file system/path traversal and filtering
 
 def glob_matcher(arg):
     if hasattr(arg, '__call__'):
         return arg
 
-    def _matcher(glob):
-        return lambda p: fnmatch.fnmatch(p, glob)
+    def _matcher(globs):
+        # one regex for all globs, same semantics as fnmatch.fnmatch
+        normcase = os.path.normcase
+        glob_re = re.compile("|".join(
+            "(?:%s)" % fnmatch.translate(normcase(glob)) for glob in globs
+        ))
+        match = glob_re.match
+        return lambda p: match(normcase(p)) is not None
 
     # arg is a sequence of glob strings
     if isinstance(arg, (tuple, list)):
-        matchers = list(map(_matcher, arg))
-        return lambda p: any((m(p) for m in matchers))
+        return _matcher(arg)
 
     # arg is a single glob string
     if isinstance(arg, (unicode, bytes)):
-        return _matcher(arg)
+        return _matcher([arg])
 
     return arg
 
+
+def dir_glob_matcher(arg):
+    """Same as glob_matcher, but a glob for the contents of a directory
+    such as "*.git/*" also matches the directory itself."""
+    matcher = glob_matcher(arg)
+    if not matcher:
+        return matcher
+    return lambda p: matcher(p) or matcher(os.path.join(p, ""))
+
 # ref -> path matching
 
 def filter_longest(_filter, iterator):
@@ -214,11 +840,77 @@ def filter_longest(_filter, iterator):
     return length, longest
 
 
+class FnDirMap(dict):
+    """Maps static filenames to the set of directories containing them.
+
+    The directories of each filename are also kept in a trie of their
+    reversed path components, so the directories which share the longest
+    suffix with a ref are found in O(path depth). Results of closest_dir
+    are memoized, as are the static files of multibust refs.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        # filename -> trie node, a node is [children, [(dirpath, parts)]]
+        self.tries = {}
+        self.memo = {}
+        # (code_dirpath, ref path) -> static filepaths of its expansions
+        self.expansion_memo = {}
+
+    def add(self, dirname, filename):
+        dirnames = self.setdefault(filename, set())
+        if dirname in dirnames:
+            return
+        dirnames.add(dirname)
+        self.memo.clear()
+        self.expansion_memo.clear()
+
+        parts = dirname.split(os.sep)
+        node = self.tries.get(filename)
+        if node is None:
+            node = self.tries[filename] = [{}, []]
+        node[1].append((dirname, parts))
+        for part in reversed(parts):
+            node = node[0].setdefault(part, [{}, []])
+            node[1].append((dirname, parts))
+
+    def closest_dir(self, code_dirpath, refdir, filename):
+        """Same as closest_matching_path for the dirs of filename"""
+        key = (code_dirpath, refdir, filename)
+        if key in self.memo:
+            return self.memo[key]
+
+        node = self.tries[filename]
+        for part in reversed(refdir.split(os.sep)):
+            if not part:
+                continue
+            if part not in node[0]:
+                break
+            node = node[0][part]
+
+        candidates = node[1]
+        closest = candidates[0][0]
+        if len(candidates) > 1:
+            code_parts = code_dirpath.split(os.sep)
+            longest = 0
+            for dirpath, parts in candidates:
+                length = 0
+                for code_part, part in zip(code_parts, parts):
+                    if code_part != part:
+                        break
+                    length += 1
+                if length > longest:
+                    closest, longest = dirpath, length
+
+        self.memo[key] = closest
+        return closest
+
+
 def mk_fn_dir_map(filepaths):
-    res = collections.defaultdict(set)
+    res = FnDirMap()
     for p in filepaths:
         dirname, filename = os.path.split(p)
-        res[filename].add(dirname)
+        res.add(dirname, filename)
     return res
 
 
@@ -261,8 +953,7 @@ def find_static_filepath(base_dir, ref_path, static_fn_dirs):
         # at least the filename must match
         return
 
-    static_dir = closest_matching_path(base_dir, dirname,
-                                       static_fn_dirs[filename])
+    static_dir = static_fn_dirs.closest_dir(base_dir, dirname, filename)
     return os.path.join(static_dir, filename)
 
 
@@ -273,26 +964,76 @@ def find_static_filepaths(base_dir, ref_paths, static_fn_dirs):
             yield static_filepath
 
 
-def expand_path(path, multibust):
-    allpaths = set([path])
-    for search, replacements in multibust.items():
-        if search in path:
-            allpaths.update((path.replace(search, r) for r in replacements))
+MULTIBUST_LIMIT = 1000
+
+
+def has_multibust_marker(path, multibust):
+    return any(marker in path for marker in multibust)
 
+
+def expand_path(path, multibust, limit=MULTIBUST_LIMIT):
+    """The path and every combination of the replacements of the
+    multibust markers in path, at most limit combinations."""
+    allpaths = set([path])
+    markers = sorted((m for m in multibust if m in path), key=path.index)
+    if not markers:
+        return allpaths
+
+    replacements = [multibust[m] for m in markers]
+    total = 1
+    for values in replacements:
+        total *= len(values)
+    if total > limit:
+        print("omnibust: only {0} of {1} expansions of '{2}' are used, "
+              "see multibust_limit".format(limit, total, path))
+
+    combinations = itertools.islice(itertools.product(*replacements), limit)
+    for combination in combinations:
+        expanded = path
+        for marker, replacement in zip(markers, combination):
+            expanded = expanded.replace(marker, replacement)
+        allpaths.add(expanded)
     return allpaths
 
 
-def ref_paths(ref, multibust):
+def ref_paths(ref, multibust, limit=MULTIBUST_LIMIT):
     if not multibust:
         yield ref.path
         return
 
-    for expanded_path in expand_path(ref.path, multibust):
+    for expanded_path in expand_path(ref.path, multibust, limit):
         yield expanded_path
-    
+
+
+def find_expanded_filepaths(base_dir, ref_path, static_fn_dirs, multibust,
+                            limit=MULTIBUST_LIMIT):
+    """Static files of all expansions of ref_path, sorted.
+
+    Results are memoized in static_fn_dirs, so a path which is referenced
+    from many codefiles in the same directory is expanded and resolved
+    only once.
+    """
+    key = (base_dir, ref_path)
+    memo = static_fn_dirs.expansion_memo
+    filepaths = memo.get(key)
+    if filepaths is None:
+        paths = expand_path(ref_path, multibust, limit)
+        filepaths = memo[key] = sorted(set(
+            find_static_filepaths(base_dir, paths, static_fn_dirs)))
+    return list(filepaths)
+
 
 # url/src/href reference parsing and rewriting
 
+# The same characters that str.splitlines splits on. Refs never span
+# lines, so parsing per line or the whole content gives the same refs.
+LINEBREAK_CHARS = "".join(unichr(c) for c in (
+    0x0d, 0x0a, 0x0b, 0x0c, 0x1c, 0x1d, 0x1e, 0x85, 0x2028, 0x2029))
+LINEBREAK_RE = re.compile("\r\n|[" + LINEBREAK_CHARS + "]")
+LF_RE = re.compile("\n")
+NON_LF_LINEBREAK_RE = re.compile(
+    "[" + LINEBREAK_CHARS.replace("\n", "") + "]")
+
 PLAIN_REF = 1
 PLAIN_REF_RE = re.compile(
     r"(url\([\"\']?|href=[\"\']|src=[\"\'])"
@@ -305,7 +1046,7 @@ PLAIN_REF_RE = re.compile(
 FN_REF = 2
 FN_REF_RE = re.compile(
     r"(url\([\"\']?|href=[\"\']?|src=[\"\']?)?"
-    "(?P<prefix>[^\"\']+?)"
+    "(?P<prefix>[^\"\'" + LINEBREAK_CHARS + "]+?)"
     "_cb_(?P<bust>[a-zA-Z0-9]{0,16})"
     "(?P<ext>\.\w+)"
     "[\?=&\w]*[\"\'\)]*"
@@ -314,12 +1055,58 @@ FN_REF_RE = re.compile(
 QS_REF = 3
 QS_REF_RE = re.compile(
     r"(url\([\"\']?|href=[\"\']?|src=[\"\']?)?"
-    "(?P<ref>[^\"\']+?)"
-    "\?(.+?&)?_cb_"
+    "(?P<ref>[^\"\'" + LINEBREAK_CHARS + "]+?)"
+    "\?([^" + LINEBREAK_CHARS + "]+?&)?_cb_"
     "(=(?P<bust>[a-zA-Z0-9]{0,16}))?"
     "[\?=&\w]*[\"\'\)]*"
 )
 
+# The same three patterns combined into one alternation, so that a single
+# scan classifies each ref. At any position, querystring refs take
+# precedence over filename refs, which take precedence over plain refs.
+REF_TRIGGER = r"(?:url\([\"\']?|href=[\"\']?|src=[\"\']?)"
+REF_TRAILER = r"[\?=&\w]*[\"\'\)]*"
+
+# A marked ref starts either at a trigger, or at the start of a line or
+# quoted string. Its path never runs across another trigger, so in a
+# minified line each url(...) is a ref of its own. Other start positions
+# are rejected right away, which keeps the lazy prefixes from being
+# retried at every position.
+MARKED_REF_START = (
+    "(?:" + REF_TRIGGER + "|(?<![^\"\'" + LINEBREAK_CHARS + "]))"
+)
+MARKED_REF_CHAR = (
+    r"(?:(?![uhs](?:rl\(|ref=|rc=))[^\"\'" + LINEBREAK_CHARS + "])"
+)
+
+QS_REF_TOKEN = (
+    MARKED_REF_START +
+    "(?P<qs_path>" + MARKED_REF_CHAR + "+?)"
+    "\?(?:[^" + LINEBREAK_CHARS + "]+?&)??_cb_"
+    "(?:=(?P<qs_bust>[a-zA-Z0-9]{0,16}))?"
+)
+FN_REF_TOKEN = (
+    MARKED_REF_START +
+    "(?P<fn_prefix>" + MARKED_REF_CHAR + "+?)"
+    "_cb_(?P<fn_bust>[a-zA-Z0-9]{0,16})"
+    "(?P<fn_ext>\.\w+)"
+)
+PLAIN_REF_TOKEN = (
+    r"(?:url\([\"\']?|href=[\"\']|src=[\"\'])"
+    "(?P<plain_path>"
+    "(?:[^\"\'\)\s\?]+\/)?"
+    "[^\/\"\'\)\s\?]+)"
+)
+
+MARKED_REF_TOKEN_RE = re.compile(
+    "(?:(?P<qs>" + QS_REF_TOKEN + ")|(?P<fn>" + FN_REF_TOKEN + "))" +
+    REF_TRAILER
+)
+REF_TOKEN_RE = re.compile(
+    "(?:(?P<qs>" + QS_REF_TOKEN + ")|(?P<fn>" + FN_REF_TOKEN + ")"
+    "|(?P<plain>" + PLAIN_REF_TOKEN + "))" + REF_TRAILER
+)
+
 
 def mk_plainref(ref):
     assert ref.type in (PLAIN_REF, FN_REF, QS_REF)
@@ -339,15 +1126,22 @@ def mk_plainref(ref):
                             .replace("?'", "'"))
 
 
+def fn_busted_path(path, bustcode):
+    basename, ext = os.path.splitext(path)
+    return basename + "_cb_" + bustcode + ext
+
+
+def qs_busted_path(path, bustcode):
+    return path + "?_cb_=" + bustcode
+
+
 def set_fn_bustcode(ref, new_bustcode):
-    _, ext = os.path.splitext(ref.path)
-    basename = ref.path[:-len(ext)]
-    fnref = basename + "_cb_" + new_bustcode + ext
+    fnref = fn_busted_path(ref.path, new_bustcode)
     return mk_plainref(ref).replace(ref.path, fnref)
 
 
 def set_qs_bustcode(ref, new_bustcode):
-    new_refpath = ref.path + "?_cb_=" + new_bustcode
+    new_refpath = qs_busted_path(ref.path, new_bustcode)
     new_ref = mk_plainref(ref).replace(ref.path, new_refpath)
     if new_refpath + "?" in new_ref:
         new_ref = new_ref.replace(new_refpath + "?", new_refpath + "&")
@@ -383,104 +1177,457 @@ def updated_fullref(ref, new_bustcode, target_reftype=None):
 
 # codefile parsing
 
-def plainref_line_parser(line):
-    for match in PLAIN_REF_RE.finditer(line):
+def find_line_ends(content):
+    """Offsets at which the 2nd, 3rd, ... line of content start"""
+    if NON_LF_LINEBREAK_RE.search(content) is None:
+        # fast path for the common case
+        return [m.end() for m in LF_RE.finditer(content)]
+    return [m.end() for m in LINEBREAK_RE.finditer(content)]
+
+
+def _iter_token_matches(content, parse_plain):
+    # Lines without '_cb_' can only contain plain refs. Only lines with
+    # '_cb_' go through the combined regex, since the lazy prefixes of the
+    # marked patterns would otherwise be retried at every position.
+    marked_re = REF_TOKEN_RE if parse_plain else MARKED_REF_TOKEN_RE
+    pos = 0
+    marked_pos = content.find("_cb_")
+    if marked_pos < 0:
+        line_ends = ()
+    else:
+        line_ends = find_line_ends(content)
+
+    while marked_pos >= 0:
+        i = bisect.bisect_right(line_ends, marked_pos)
+        line_start = line_ends[i - 1] if i > 0 else 0
+        line_end = line_ends[i] if i < len(line_ends) else len(content)
+        if parse_plain and pos < line_start:
+            for match in PLAIN_REF_RE.finditer(content, pos, line_start):
+                yield match
+        for match in marked_re.finditer(content, line_start, line_end):
+            yield match
+        pos = line_end
+        marked_pos = content.find("_cb_", line_end)
+
+    if parse_plain:
+        for match in PLAIN_REF_RE.finditer(content, pos):
+            yield match
+
+
+def iter_ref_tokens(content, parse_plain=True):
+    """Yield (full_ref, path, bustcode, type, offset) of each ref in
+    content in a single scan, ordered by offset."""
+    for match in _iter_token_matches(content, parse_plain):
         full_ref = match.group()
-        if "_cb_" in full_ref:
+        if "data:image/" in full_ref:
             continue
 
-        ref_path = match.group('path')
+        kind = match.lastgroup
+        if kind == 'qs':
+            yield (full_ref, match.group('qs_path'),
+                   match.group('qs_bust'), QS_REF, match.start())
+        elif kind == 'fn':
+            yield (full_ref,
+                   match.group('fn_prefix') + match.group('fn_ext'),
+                   match.group('fn_bust'), FN_REF, match.start())
+        elif "_cb_" not in full_ref:
+            # plain matches come from either REF_TOKEN_RE or PLAIN_REF_RE
+            path = match.group('plain_path' if kind == 'plain' else 'path')
+            yield full_ref, path, "", PLAIN_REF, match.start()
 
-        yield full_ref, ref_path, "", PLAIN_REF
+
+def plainref_line_parser(line):
+    for token in iter_ref_tokens(line):
+        if token[3] == PLAIN_REF:
+            yield token[:4]
 
 
 def markedref_line_parser(line):
-    if "_cb_" not in line:
-        return
+    for token in iter_ref_tokens(line, parse_plain=False):
+        yield token[:4]
 
-    for match in FN_REF_RE.finditer(line):
-        full_ref = match.group()
-        ref_path = match.group('prefix') + match.group('ext')
-        bust = match.group('bust')
-        yield full_ref, ref_path, bust, FN_REF
 
-    for match in QS_REF_RE.finditer(line):
-        full_ref = match.group()
-        ref_path = match.group('ref')
-        bust = match.group('bust')
-        yield full_ref, ref_path, bust, QS_REF
+def parse_content_refs(content, parse_plain=True):
+    line_ends = None
+    if NON_LF_LINEBREAK_RE.search(content) is not None:
+        line_ends = find_line_ends(content)
+
+    refs = []
+    lineno, prev_offset = 1, 0
+    for full_ref, path, bust, reftype, offset in iter_ref_tokens(
+            content, parse_plain):
+        if line_ends is None:
+            # tokens are ordered, so only count from the previous one
+            lineno += content.count("\n", prev_offset, offset)
+            prev_offset = offset
+        else:
+            lineno = bisect.bisect_right(line_ends, offset) + 1
+        refs.append(Ref("", "", lineno, full_ref, path, bust, reftype,
+                        offset))
+    return refs
 
 
-def parse_refs(line_parser, content):
-    for lineno, line in enumerate(content.splitlines()):
-        for match in line_parser(line):
-            fullref = match[0]
-            if "data:image/" in fullref:
-                continue
-            yield Ref("", "", lineno + 1, *match)
+# Substrings without which a codefile can't contain any refs. Files
+# without them are skipped before they are decoded.
+PLAIN_REF_TRIGGERS = (b"_cb_", b"url(", b"href=", b"src=")
+MARKED_REF_TRIGGERS = (b"_cb_",)
 
 
-def parse_content_refs(content, parse_plain=True):
-    all_refs = []
-    if parse_plain:
-        all_refs.extend(parse_refs(plainref_line_parser, content))
+def is_ascii_compatible(encoding):
+    """Whether the triggers can be searched for in the undecoded bytes"""
+    try:
+        return "\x00url(".encode(encoding) == b"\x00url("
+    except (LookupError, UnicodeError):
+        return False
 
-    if "_cb_" in content:
-        all_refs.extend(parse_refs(markedref_line_parser, content))
-    
-    seen = {}
-    for ref in all_refs:
-        key = (ref.lineno, ref.full_ref)
-        if key not in seen or seen[key].type < ref.type:
-            seen[key] = ref
-    return sorted(seen.values(), key=lambda r: r.lineno)
+
+def has_ref_triggers(data, parse_plain=True):
+    if b"\x00" in data:
+        # binary file
+        return False
+    triggers = PLAIN_REF_TRIGGERS if parse_plain else MARKED_REF_TRIGGERS
+    return any(trigger in data for trigger in triggers)
 
 
-def iter_refs(codefile_paths, parse_plain=True, encoding='utf-8'):
-    for codefile_path in codefile_paths:
-        code_dir, code_fn = os.path.split(codefile_path)
-        try:
-            with codecs.open(codefile_path, 'r', encoding) as fp:
-                content = fp.read()
-        except Exception as e:
-            print("omnibust: error reading '{0}' ('{1}')".format(codefile_path, e))
+def parse_codefile_data(data, parse_plain=True, encoding='utf-8'):
+    """Parse the undecoded content of a codefile into compact (lineno,
+    full_ref, path, bustcode, type, offset) records, which are cheap to
+    send between processes.
+
+    Returns None if the codefile was skipped without being decoded.
+    """
+    if is_ascii_compatible(encoding) and not has_ref_triggers(data,
+                                                              parse_plain):
+        return None
+    content = data.decode(encoding)
+    return [tuple(ref[2:]) for ref in parse_content_refs(content, parse_plain)]
+
+
+def parse_codefile(codefile_path, parse_plain=True, encoding='utf-8'):
+    with open(codefile_path, 'rb') as fp:
+        data = fp.read()
+    return parse_codefile_data(data, parse_plain, encoding)
+
+
+def _parse_codefile_task(task):
+    codefile_path, parse_plain, encoding = task
+    try:
+        with open(codefile_path, 'rb') as fp:
+            data = fp.read()
+        records = parse_codefile_data(data, parse_plain, encoding)
+        return codefile_path, records, None, len(data)
+    except Exception as e:
+        return codefile_path, None, unicode(e), 0
+
+
+def _parse_indexed_codefile_task(task):
+    """Same as _parse_codefile_task, unless the stat key of the codefile
+    is still the indexed key, in which case the result is None."""
+    codefile_path, parse_plain, encoding, indexed_key = task
+    try:
+        key = stat_key(os.stat(codefile_path))
+    except OSError:
+        key = None
+    if key is not None and key == indexed_key:
+        return codefile_path, key, None
+    # stat before reading, a change in between is caught by the next run
+    return codefile_path, key, _parse_codefile_task(task[:3])
+
+
+PARSE_CHUNKSIZE = 16
+
+
+def mk_parse_stats():
+    return {'scanned': 0, 'skipped': 0, 'bytes_read': 0}
+
+
+def imap_tasks(func, tasks, jobs=1):
+    """Lazily map func over tasks, in a process pool if jobs > 1"""
+    if jobs <= 1:
+        for result in map(func, tasks):
+            yield result
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # imap keeps the order of tasks
+        for result in pool.imap(func, tasks, PARSE_CHUNKSIZE):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def count_parse_result(result, parse_stats):
+    codefile_path, records, error, nbytes = result
+    parse_stats['bytes_read'] += nbytes
+    if error is None and records is None:
+        parse_stats['skipped'] += 1
+        records = []
+    elif error is None:
+        parse_stats['scanned'] += 1
+    return codefile_path, records, error
+
+
+def iter_parsed_codefiles(codefile_paths, parse_plain=True, encoding='utf-8',
+                          jobs=1, parse_stats=None):
+    """Yield (codefile_path, records, error) for each codefile.
+
+    parse_stats is updated with the number of scanned codefiles, the
+    number of codefiles skipped by the prefilter and the bytes read.
+    """
+    if parse_stats is None:
+        parse_stats = mk_parse_stats()
+
+    tasks = ((p, parse_plain, encoding) for p in codefile_paths)
+    for result in imap_tasks(_parse_codefile_task, tasks, jobs):
+        yield count_parse_result(result, parse_stats)
+
+
+def iter_indexed_codefiles(codefile_paths, ref_index, parse_plain=True,
+                           encoding='utf-8', jobs=1, parse_stats=None):
+    """Same as iter_parsed_codefiles, but codefiles which didn't change
+    since they were added to ref_index are not parsed again.
+
+    Codefiles are checked against ref_index as they are walked, so the
+    first codefile is yielded before the walk is done. Each codefile is
+    added to the new index of ref_index right away, codefiles which are
+    not walked are left out of it.
+    """
+    if parse_stats is None:
+        parse_stats = mk_parse_stats()
+
+    tasks = ((p, parse_plain, encoding, ref_index.key(p))
+             for p in codefile_paths)
+    for path, key, result in imap_tasks(_parse_indexed_codefile_task, tasks,
+                                        jobs):
+        if result is None:
+            records = ref_index.records(path)
+            ref_index.add(path, key, records)
+            yield path, records, None
             continue
-        
-        for ref in parse_content_refs(content, parse_plain):
-            yield ref._replace(code_dir=code_dir, code_fn=code_fn)
+
+        path, records, error = count_parse_result(result, parse_stats)
+        if error is None and key is not None:
+            ref_index.add(path, key, records)
+        yield path, records, error
+
+
+def iter_refs(codefile_paths, parse_plain=True, encoding='utf-8', jobs=1,
+              ref_index=None, parse_stats=None):
+    if ref_index is None:
+        parsed = iter_parsed_codefiles(codefile_paths, parse_plain, encoding,
+                                       jobs, parse_stats)
+    else:
+        parsed = iter_indexed_codefiles(codefile_paths, ref_index,
+                                        parse_plain, encoding, jobs,
+                                        parse_stats)
+    for codefile_path, records, error in parsed:
+        if error is not None:
+            print("omnibust: error reading '{0}' ('{1}')".format(codefile_path,
+                                                                  error))
+            continue
+
+        code_dir, code_fn = os.path.split(codefile_path)
+        for record in records:
+            yield Ref(code_dir, code_fn, *record)
 
 
 # project dir scanning
 
 
-def iter_filepaths(rootdir, file_filter=None, file_exclude=None,
-                   dir_filter=None, dir_exclude=None):
+class FileEntry(object):
+    """Minimal os.DirEntry for pythons without os.scandir"""
+
+    __slots__ = ('path', '_stat')
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def _walk_entries(rootdir, dir_exclude=None):
+    """Same as os.walk, but yields the os.DirEntry objects of files.
+
+    Entries cache the result of stat, so a file which is busted later
+    doesn't have to be stat-ed again.
+    """
+    if not hasattr(os, 'scandir'):
+        for root, dirnames, filenames in os.walk(rootdir):
+            if dir_exclude:
+                dirnames[:] = [d for d in dirnames
+                               if not dir_exclude(os.path.join(root, d))]
+            yield root, [FileEntry(os.path.join(root, fn))
+                         for fn in filenames]
+        return
+
+    stack = [rootdir]
+    while stack:
+        root = stack.pop()
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            continue
+
+        subdirs = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry)
+            elif not entry.is_symlink():
+                if not (dir_exclude and dir_exclude(entry.path)):
+                    subdirs.append(entry.path)
+
+        yield root, files
+        stack.extend(reversed(subdirs))
+
+
+def iter_fileentries(rootdir, file_filter=None, file_exclude=None,
+                     dir_filter=None, dir_exclude=None):
     file_filter = glob_matcher(file_filter)
     file_exclude = glob_matcher(file_exclude)
     dir_filter = glob_matcher(dir_filter)
-    dir_exclude = glob_matcher(dir_exclude)
+    dir_exclude = dir_glob_matcher(dir_exclude)
 
-    for root, _, files in os.walk(rootdir):
-        if dir_exclude and dir_exclude(root):
-            continue
+    if dir_exclude and dir_exclude(rootdir):
+        return
 
+    # excluded directories are not walked at all
+    for root, entries in _walk_entries(rootdir, dir_exclude):
         if dir_filter and not dir_filter(root):
             continue
 
-        for filename in files:
-            path = os.path.join(root, filename)
+        for entry in entries:
+            path = entry.path
 
             if file_exclude and file_exclude(path):
                 continue
 
             if not file_filter or file_filter(path):
-                yield path
+                yield entry
 
 
-def multi_iter_filepaths(rootdirs, *args, **kwargs):
+def iter_filepaths(*args, **kwargs):
+    for entry in iter_fileentries(*args, **kwargs):
+        yield entry.path
+
+
+def multi_iter_fileentries(rootdirs, *args, **kwargs):
     for basedir in rootdirs:
-        for path in iter_filepaths(basedir, *args, **kwargs):
-            yield path
+        for entry in iter_fileentries(basedir, *args, **kwargs):
+            yield entry
+
+
+def multi_iter_filepaths(rootdirs, *args, **kwargs):
+    for entry in multi_iter_fileentries(rootdirs, *args, **kwargs):
+        yield entry.path
+
+
+# git checkouts
+#
+# In a git checkout, git lists the files of the project, honoring
+# .gitignore. Files which are unchanged since they were checked out are
+# busted by their blob id, which unlike their mtime is the same in every
+# clone, and which doesn't require reading the file.
+
+GIT_FILE_MODES = ("100644", "100755")
+
+
+def run_git(*args, **kwargs):
+    check = kwargs.get('check', True)
+    try:
+        proc = subprocess.Popen(("git",) + args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=kwargs.get('cwd'))
+        out, err = proc.communicate()
+    except OSError as e:
+        raise BaseError("git mode requires git ({0})".format(e))
+
+    if check and proc.returncode != 0:
+        raise BaseError("'git {0}' failed ({1})".format(
+            args[0], err.decode('utf-8', 'replace').strip()))
+    return out
+
+
+def split_git_paths(out, root=None):
+    """Paths of the -z output of git, relative to the directory git ran
+    in, or joined to root"""
+    return [os.path.normpath(os.path.join(root or "", p))
+            for p in out.decode('utf-8').split("\0") if p]
+
+
+def git_filepaths(root=None):
+    """Tracked and untracked files which are not ignored"""
+    listed = split_git_paths(run_git("ls-files", "-z", "--cached",
+                                     "--others", "--exclude-standard",
+                                     cwd=root), root)
+    deleted = set(split_git_paths(run_git("ls-files", "-z", "--deleted",
+                                          cwd=root), root))
+    # unmerged files are listed once per stage
+    seen = set()
+    filepaths = []
+    for path in listed:
+        if path not in deleted and path not in seen:
+            seen.add(path)
+            filepaths.append(path)
+    return filepaths
+
+
+def git_blob_ids(root=None):
+    """Map paths of files which are unchanged since they were checked
+    out (or staged) to their blob id"""
+    # update the stat info of the index, so files which were only touched
+    # aren't reported as changed, same as 'git status' does
+    run_git("update-index", "-q", "--refresh", check=False, cwd=root)
+
+    blob_ids = {}
+    for line in run_git("ls-files", "-z", "--stage",
+                        cwd=root).decode('utf-8').split("\0"):
+        if not line:
+            continue
+        info, path = line.split("\t", 1)
+        mode, blob_id, stage = info.split()
+        # symlinks and submodules don't have the content of a file
+        if stage == "0" and mode in GIT_FILE_MODES:
+            blob_ids[os.path.normpath(os.path.join(root or "", path))] = \
+                blob_id
+
+    changed = run_git("diff-files", "-z", "--name-only", "--relative",
+                      cwd=root)
+    for path in split_git_paths(changed, root):
+        blob_ids.pop(path, None)
+    return blob_ids
+
+
+def iter_git_entries(rootdirs, filepaths, file_filter=None,
+                     file_exclude=None):
+    """Same as multi_iter_fileentries, for the files listed by git"""
+    file_filter = glob_matcher(file_filter)
+    file_exclude = glob_matcher(file_exclude)
+
+    for rootdir in rootdirs:
+        for path in filepaths:
+            relpath = os.path.relpath(path, rootdir)
+            if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                continue
+
+            # yield the path in the form it has when walking rootdir
+            path = os.path.join(rootdir, relpath)
+            if file_exclude and file_exclude(path):
+                continue
+
+            if not file_filter or file_filter(path):
+                yield FileEntry(path)
 
 
 def init_project_paths():
@@ -491,13 +1638,56 @@ def init_project_paths():
     return codefile_paths, static_filepaths
 
 
-def cfg_project_paths(cfg):
-    code_filepaths = multi_iter_filepaths(cfg['code_dirs'],
-                                          cfg['code_fileglobs'],
-                                          cfg['ignore_dirglobs'])
-    static_filepaths = multi_iter_filepaths(cfg['static_dirs'],
-                                            cfg['static_fileglobs'],
-                                            cfg['ignore_dirglobs'])
+def iter_cached_entry_paths(entries, stat_cache):
+    for entry in entries:
+        stat_cache[entry.path] = entry
+        yield entry.path
+
+
+def cfg_file_exclude(cfg):
+    # files written by 'omnibust publish' are never scanned
+    return cfg['ignore_dirglobs'] + PUBLISHED_FILEGLOBS
+
+
+def iter_unique_paths(paths):
+    """Skip paths which were already yielded, code_dirs like "./static"
+    and "." overlap"""
+    seen = set()
+    for path in paths:
+        normpath = os.path.normpath(path)
+        if normpath not in seen:
+            seen.add(normpath)
+            yield path
+
+
+def cfg_project_paths(cfg, stat_cache=None):
+    """If stat_cache is a dict, the entries of static files are added to
+    it as they are walked."""
+    if cfg.get('git'):
+        filepaths = git_filepaths(cfg.get('root'))
+        code_filepaths = (entry.path for entry in iter_git_entries(
+            cfg['code_dirs'], filepaths, cfg['code_fileglobs'],
+            cfg_file_exclude(cfg)))
+        static_entries = iter_git_entries(cfg['static_dirs'], filepaths,
+                                          cfg['static_fileglobs'],
+                                          cfg_file_exclude(cfg))
+    else:
+        code_filepaths = multi_iter_filepaths(
+            cfg['code_dirs'], cfg['code_fileglobs'], cfg_file_exclude(cfg),
+            dir_exclude=cfg['ignore_dirglobs'])
+        static_entries = multi_iter_fileentries(
+            cfg['static_dirs'], cfg['static_fileglobs'],
+            cfg_file_exclude(cfg), dir_exclude=cfg['ignore_dirglobs'])
+    if cfg.get('manifest_file'):
+        # the manifest is full of busted urls, but they are ours
+        manifest_path = os.path.abspath(cfg['manifest_file'])
+        code_filepaths = (p for p in code_filepaths
+                          if os.path.abspath(p) != manifest_path)
+    code_filepaths = iter_unique_paths(code_filepaths)
+    if stat_cache is None:
+        static_filepaths = (entry.path for entry in static_entries)
+    else:
+        static_filepaths = iter_cached_entry_paths(static_entries, stat_cache)
     return code_filepaths, static_filepaths
 
 
@@ -515,10 +1705,42 @@ def ref_print_wrapper(refs):
         yield ref, paths, new_full_ref
 
 
-def busted_refs(ref_map, cfg, target_reftype):
-    buster = mk_buster(cfg['hash_function'], cfg['digest_length'],
-                       cfg['stat_length'])
+def prehash_paths(buster, paths, jobs, pool=None):
+    """Populate the cache of buster, hashing up to jobs files at once.
+
+    If pool is a ThreadPool, it is used instead of starting a new one.
+    """
+    paths = sorted(set(paths))
+    if jobs <= 1 or len(paths) <= 1:
+        return
+
+    if pool is not None:
+        pool.map(buster.bust_file, paths)
+        return
+
+    pool = ThreadPool(min(jobs, len(paths)))
+    try:
+        pool.map(buster.bust_file, paths)
+    finally:
+        pool.close()
+        pool.join()
 
+
+def busted_refs(ref_map, cfg, target_reftype, buster=None, stats=None,
+                pool=None):
+    if buster is None:
+        buster = mk_cfg_buster(cfg)
+
+    with stats_stage(stats, 'hash'):
+        prehash_paths(buster, flatten(ref_map.values()), cfg.get('jobs', 1),
+                      pool)
+
+    busted = iter_busted_refs(ref_map, target_reftype, buster)
+    for busted in stats_iter(stats, 'hash', busted):
+        yield busted
+
+
+def iter_busted_refs(ref_map, target_reftype, buster):
     for ref, paths in ref_map.items():
         new_bustcode = buster(paths)
         if ref.bustcode == new_bustcode and (target_reftype is None or
@@ -527,59 +1749,1100 @@ def busted_refs(ref_map, cfg, target_reftype):
         yield ref, paths, updated_fullref(ref, new_bustcode, target_reftype)
 
 
-def rewrite_content(ref, new_full_ref):
-    # TODO: better handling of file encoding
-    with codecs.open(ref_codepath(ref), 'r', encoding='utf-8') as f:
-        content = f.read()
+# cascade resolution
 
-    with codecs.open(ref_codepath(ref), 'w', encoding='utf-8') as f:
-        f.write(content.replace(ref.full_ref, new_full_ref))
+def group_ref_map(ref_map):
+    """Split ref_map into one ref map per (normalized) codefile path"""
+    file_ref_maps = collections.OrderedDict()
+    for ref, paths in ref_map.items():
+        codepath = os.path.normpath(ref_codepath(ref))
+        if codepath not in file_ref_maps:
+            file_ref_maps[codepath] = collections.OrderedDict()
+        file_ref_maps[codepath][ref] = paths
+    return file_ref_maps
+
+
+def mk_ref_graph(file_ref_maps):
+    """Map each codefile to the codefiles it references as static files.
+
+    Static files that are also codefiles (css, js) have to be rewritten
+    before the references to them can be busted.
+    """
+    graph = collections.OrderedDict()
+    for codepath, file_ref_map in file_ref_maps.items():
+        deps = graph[codepath] = []
+        for path in flatten(file_ref_map.values()):
+            path = os.path.normpath(path)
+            if path in file_ref_maps and path not in deps:
+                deps.append(path)
+    return graph
+
+
+def toposort(graph):
+    """Order nodes so that every node comes after its dependencies.
+
+    Dependencies which would close a cycle are reported and ignored.
+    """
+    order = []
+    visiting, done = set(), set()
+    for root in graph:
+        if root in done:
+            continue
 
+        visiting.add(root)
+        stack = [(root, iter(graph[root]))]
+        while stack:
+            node, deps = stack[-1]
+            for dep in deps:
+                if dep in visiting:
+                    print("omnibust: reference cycle, '{0}' references "
+                          "'{1}'".format(node, dep))
+                    continue
+                if dep not in done:
+                    visiting.add(dep)
+                    stack.append((dep, iter(graph[dep])))
+                    break
+            else:
+                stack.pop()
+                visiting.remove(node)
+                done.add(node)
+                order.append(node)
+    return order
+
+
+def replace_refs(content, updates):
+    """Replace each ref at the offset where it was parsed"""
+    chunks = []
+    pos = 0
+    for ref, new_full_ref in sorted(updates, key=lambda u: u[0].offset):
+        start = ref.offset
+        end = start + len(ref.full_ref)
+        if start < pos or content[start:end] != ref.full_ref:
+            # overlaps a previous ref or the file changed since parsing
+            print("omnibust: skipping '{0}' in '{1}'".format(
+                ref.full_ref, ref_codepath(ref)))
+            continue
 
-def _scan_project(codefile_paths, static_filepaths, multibust=None,
-                 parse_plain=True, encoding='utf-8'):
-    refs = collections.OrderedDict()
+        chunks.append(content[pos:start])
+        chunks.append(new_full_ref)
+        pos = end
 
-    # init mapping to check if a ref has a static file
-    static_fn_dirs = mk_fn_dir_map(static_filepaths)
+    chunks.append(content[pos:])
+    return "".join(chunks)
+
+
+replace_file = getattr(os, 'replace', os.rename)
 
-    for ref in iter_refs(codefile_paths, parse_plain, encoding=encoding):
-        paths = ref_paths(ref, multibust) if multibust else [ref.path] 
-        reffed_filepaths = list(find_static_filepaths(ref.code_dir, paths,
-                                                      static_fn_dirs))
+
+def file_mode(path):
+    """Permissions of the file at path, or the default for new files"""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_atomic(path, data):
+    """Replace the file at path with data, keeping its permissions"""
+    # a symlinked codefile stays a symlink, its target is replaced
+    path = os.path.realpath(path)
+    dirname, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + filename + ".",
+                                    suffix=".tmp", dir=dirname or ".")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, file_mode(path))
+        replace_file(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def rewrite_content(codepath, updates, encoding='utf-8'):
+    """Returns False if the content didn't change and nothing was written"""
+    # content is decoded and encoded as a whole, so newlines and any
+    # byte order mark are written back exactly as they were read
+    with open(codepath, 'rb') as f:
+        data = f.read()
+
+    new_data = replace_refs(data.decode(encoding), updates).encode(encoding)
+    if new_data == data:
+        return False
+
+    write_atomic(codepath, new_data)
+    return True
+
+
+def group_updates(refs):
+    """Group (ref, paths, new_full_ref) by codefile, keeping their order"""
+    updates = collections.OrderedDict()
+    for ref, paths, new_full_ref in refs:
+        updates.setdefault(ref_codepath(ref), []).append((ref, new_full_ref))
+    return updates
+
+
+def rewrite_codefiles(file_ref_maps, target_reftype, buster,
+                      encoding='utf-8', aliases=None, stats=None,
+                      printer=ref_print_wrapper):
+    """Bust and rewrite the refs of codefiles in dependency order. The
+    updated refs are passed through printer, unless it is None.
+
+    Returns the codepaths of the files that were rewritten.
+    """
+    rewritten = []
+    with stats_stage(stats, 'rewrite'):
+        for codepath in toposort(mk_ref_graph(file_ref_maps)):
+            refs = iter_busted_refs(file_ref_maps[codepath], target_reftype,
+                                    buster)
+            if printer is not None:
+                refs = printer(refs)
+
+            for path, updates in group_updates(refs).items():
+                if rewrite_content(path, updates, encoding):
+                    buster.invalidate((aliases or {}).get(codepath)
+                                      or [codepath])
+                    rewritten.append(codepath)
+
+    if stats is not None:
+        stats.counters['rewrite_passes'] += 1
+        stats.counters['files_rewritten'] += len(rewritten)
+    return rewritten
+
+
+def resolve_refs(refs, static_fn_dirs, multibust=None,
+                 multibust_limit=MULTIBUST_LIMIT):
+    for ref in refs:
+        if multibust and has_multibust_marker(ref.path, multibust):
+            reffed_filepaths = find_expanded_filepaths(
+                ref.code_dir, ref.path, static_fn_dirs, multibust,
+                multibust_limit)
+        else:
+            reffed_filepaths = list(find_static_filepaths(
+                ref.code_dir, [ref.path], static_fn_dirs))
         if reffed_filepaths:
-            refs[ref] = reffed_filepaths
+            yield ref, reffed_filepaths
+
+
+def iter_scan_project(codefile_paths, static_filepaths, multibust=None,
+                      parse_plain=True, encoding='utf-8', jobs=1,
+                      ref_index=None, parse_stats=None, stats=None,
+                      multibust_limit=MULTIBUST_LIMIT):
+    """Yield (codepath, ref_map) for one codefile at a time.
+
+    Only the static filepaths are collected up front, refs are parsed and
+    resolved as the codefiles are walked.
+    """
+    if stats is not None:
+        codefile_paths = stats.timed_iter('walk', codefile_paths,
+                                          'code_files')
+        static_filepaths = stats.timed_iter('walk', static_filepaths,
+                                            'static_files')
+        if parse_stats is None:
+            parse_stats = stats.counters
 
-    return refs
+    # init mapping to check if a ref has a static file
+    with stats_stage(stats, 'index'):
+        static_fn_dirs = mk_fn_dir_map(static_filepaths)
+
+    refs = iter_refs(codefile_paths, parse_plain, encoding=encoding, jobs=jobs,
+                     ref_index=ref_index, parse_stats=parse_stats)
+    refs = stats_iter(stats, 'parse', refs, 'refs_found')
+    # refs of a codefile are always consecutive
+    for codepath, file_refs in itertools.groupby(refs, ref_codepath):
+        resolved = stats_iter(stats, 'resolve',
+                              resolve_refs(file_refs, static_fn_dirs,
+                                           multibust, multibust_limit),
+                              'refs_resolved')
+        yield codepath, collections.OrderedDict(resolved)
+
+
+def _scan_project(*args, **kwargs):
+    ref_map = collections.OrderedDict()
+    for _, file_ref_map in iter_scan_project(*args, **kwargs):
+        ref_map.update(file_ref_map)
+    return ref_map
+
+
+def iter_project_ref_maps(args, cfg, stat_cache=None, stats=None,
+                          parse_plain=None):
+    """Same as iter_scan_project with the paths and options of cfg. The new
+    ref index replaces the old one once all codefiles have been
+    yielded."""
+    if parse_plain is None:
+        parse_plain = get_target_reftype(args) is not None
+    ref_index = open_cfg_ref_index(cfg, parse_plain)
+    file_ref_maps = iter_scan_project(*cfg_project_paths(cfg, stat_cache),
+                                      multibust=cfg['multibust'],
+                                      parse_plain=parse_plain,
+                                      encoding=cfg['file_encoding'],
+                                      jobs=cfg['jobs'],
+                                      ref_index=ref_index,
+                                      stats=stats,
+                                      multibust_limit=cfg['multibust_limit'])
+    committed = False
+    try:
+        for codepath, ref_map in file_ref_maps:
+            yield codepath, ref_map
+        committed = True
+    finally:
+        if ref_index is not None:
+            ref_index.close(commit=committed)
 
 
-def scan_project(args, cfg):
-    target_reftype = get_target_reftype(args)
-    return _scan_project(*cfg_project_paths(cfg), multibust=cfg['multibust'],
-                        parse_plain=target_reftype is not None,
-                        encoding=cfg['file_encoding'])
+def scan_project(args, cfg, stat_cache=None, stats=None, parse_plain=None):
+    ref_map = collections.OrderedDict()
+    for _, file_ref_map in iter_project_ref_maps(args, cfg, stat_cache,
+                                                 stats, parse_plain):
+        ref_map.update(file_ref_map)
+    return ref_map
+
+# manifest
+#
+# Instead of rewriting codefiles, an application can look up busted urls
+# in a manifest. It has an entry for each static file, keyed by its path
+# relative to the project directory, and one for each ref path found in
+# the codefiles. The digests of the static files are kept in the manifest,
+# so regenerating it only hashes files which changed.
+
+MANIFEST_VERSION = 1
+
+
+def manifest_params(hash_function, digest_length):
+    return {
+        'manifest_version': MANIFEST_VERSION,
+        'hash_function': hash_function,
+        'digest_length': digest_length,
+    }
+
+
+def manifest_url(path):
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def mk_manifest_entry(url, paths, bustcode):
+    return collections.OrderedDict([
+        ('bustcode', bustcode),
+        ('querystring', qs_busted_path(url, bustcode)),
+        ('filename', fn_busted_path(url, bustcode)),
+        ('paths', sorted(set(manifest_url(p) for p in paths))),
+    ])
+
+
+def mk_manifest(ref_map, static_filepaths, buster):
+    """Map urls to their bustcode and busted urls"""
+    urls = collections.OrderedDict()
+    for path in sorted(static_filepaths, key=manifest_url):
+        url = manifest_url(path)
+        urls[url] = mk_manifest_entry(url, [path], buster([path]))
+
+    for ref, paths in ref_map.items():
+        # the first codefile to reference a path determines its entry
+        if ref.path not in urls:
+            urls[ref.path] = mk_manifest_entry(ref.path, paths, buster(paths))
+    return urls
+
+
+def dump_manifest(manifest_path, urls, digest_cache, hash_function,
+                  digest_length):
+    """Returns False if the manifest didn't change and nothing was written"""
+    data = dict(manifest_params(hash_function, digest_length),
+                urls=urls, files=digest_cache)
+    new_data = json.dumps(data, indent=4, sort_keys=True).encode('utf-8')
+    try:
+        with open(manifest_path, 'rb') as f:
+            if f.read() == new_data:
+                return False
+    except (IOError, OSError):
+        pass
+
+    write_atomic(manifest_path, new_data)
+    return True
+
+
+def load_manifest(manifest_path):
+    """Load the urls of a manifest written by 'omnibust manifest'"""
+    with codecs.open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)['urls']
+
+
+def busted_url(manifest, url, reftype=QS_REF):
+    """Look up the busted url of url in a manifest loaded with load_manifest.
+
+    Urls which are not in the manifest are returned unchanged.
+    """
+    entry = manifest.get(url)
+    if entry is None:
+        entry = manifest.get(url.lstrip("/"))
+        if entry is None:
+            return url
+
+    if reftype == FN_REF:
+        return fn_busted_path(url, entry['bustcode'])
+    return qs_busted_path(url, entry['bustcode'])
+
+# publish
+#
+# Webservers can only serve filename refs directly if a file with the
+# busted filename exists. Publishing creates these files for every entry
+# of the manifest, as hardlinks to the static files where possible, and
+# removes files of earlier bustcodes. Hardlinks share their content with
+# the static file, so static files should be replaced (as omnibust
+# rewrite does), rather than modified in place.
+
+PUBLISHED_FILEGLOBS = ["*_cb_*.*"]
+PUBLISHED_FN_RE = re.compile(r"_cb_[a-zA-Z0-9]{1,16}(\.\w+)$")
+
+
+def unpublished_path(path):
+    """The path without its bustcode, None if it isn't a published path"""
+    dirname, filename = os.path.split(path)
+    unbusted, n = PUBLISHED_FN_RE.subn(r"\1", filename)
+    if n == 0:
+        return None
+    return os.path.join(dirname, unbusted)
+
+
+def publish_path(path, publish_dir=None):
+    """Where the published files of path are written"""
+    if publish_dir is None:
+        return path
+
+    relpath = os.path.normpath(path)
+    if os.path.isabs(relpath) or relpath.split(os.sep)[0] == os.pardir:
+        raise PathError("can't publish files outside of the project", path)
+    return os.path.join(publish_dir, relpath)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+        return
+    except (AttributeError, OSError):
+        # no hardlinks on this platform, across devices or filesystems
+        pass
+
+    dirname, filename = os.path.split(dst)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + filename + ".",
+                                    suffix=".tmp", dir=dirname or ".")
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp_path)
+        replace_file(tmp_path, dst)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def mk_publish_targets(urls, publish_dir=None):
+    """Map published paths to the static file they are created from and
+    its bustcode"""
+    targets = collections.OrderedDict()
+    for entry in urls.values():
+        for path in entry['paths']:
+            path = os.path.normpath(path)
+            target = fn_busted_path(publish_path(path, publish_dir),
+                                    entry['bustcode'])
+            targets[target] = (path, entry['bustcode'])
+    return targets
+
+
+def publish_files(targets):
+    """Returns the paths of the files which didn't exist yet"""
+    created = []
+    for target, (path, _) in targets.items():
+        if os.path.exists(target):
+            continue
+        dirname = os.path.dirname(target)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        link_or_copy(path, target)
+        created.append(target)
+    return created
+
+
+def remove_stale_files(targets, rootdirs, ignore_dirglobs=(),
+                       publish_dir=None):
+    """Remove published files in rootdirs of earlier bustcodes.
+
+    Files of the static files in targets are removed, as are files whose
+    static file no longer exists. Other files with busted filenames are
+    left alone. Gzip sidecars are removed along with their published file.
+    """
+    current = set(map(os.path.normpath, targets))
+    unbusted = set(unpublished_path(p) for p in current)
+    published = multi_iter_filepaths(rootdirs, PUBLISHED_FILEGLOBS,
+                                     dir_exclude=ignore_dirglobs)
+    removed = []
+    for path in list(published):
+        path = os.path.normpath(path)
+        target = path[:-len(GZIP_EXT)] if path.endswith(GZIP_EXT) else path
+        if target in current:
+            continue
+        unbusted_target = unpublished_path(target)
+        if unbusted_target is None:
+            continue
+        if publish_dir is None:
+            source = unbusted_target
+        else:
+            source = os.path.relpath(unbusted_target, publish_dir)
+        if unbusted_target in unbusted or not os.path.exists(source):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+# gzip sidecars
+#
+# Webservers can serve a precompressed 'app.js.gz' instead of compressing
+# 'app.js' for every request (gzip_static in nginx). Sidecars are only
+# made for text files and only kept if they are smaller than the file
+# itself. The gzip index records the bustcode each sidecar was made from,
+# so files with an unchanged bustcode are not compressed again.
+
+GZIP_EXT = ".gz"
+
+
+def gzip_file(path, level=6, bufsize=DIGEST_BUFSIZE):
+    # 16 + MAX_WBITS produces a gzip header and trailer. The header has no
+    # filename and a zero mtime, so the same content gives the same bytes.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    chunks = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return b"".join(chunks)
+
+
+def write_sidecar(path, sidecar_path, level=6):
+    """Returns False if compression doesn't save space. A sidecar of an
+    earlier version is removed in that case."""
+    data = gzip_file(path, level)
+    if len(data) >= os.path.getsize(path):
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+        return False
+
+    write_atomic(sidecar_path, data)
+    return True
+
+
+def is_current_sidecar(entry, bustcode, sidecar_path):
+    if not entry or entry[0] != bustcode:
+        return False
+    # files which didn't compress well have no sidecar
+    return not entry[1] or os.path.exists(sidecar_path)
+
+
+def gzip_sidecars(sources, level=6, jobs=1, gzip_index=None):
+    """Write sidecars for sources, which maps sidecar paths to the path of
+    the file and its bustcode. Up to jobs files are compressed at once.
+
+    gzip_index is updated with the bustcode of each sidecar. Returns the
+    paths of the sidecars which were written.
+    """
+    if gzip_index is None:
+        gzip_index = {}
+
+    pending = [(sidecar_path, path, bustcode)
+               for sidecar_path, (path, bustcode) in sources.items()
+               if not is_current_sidecar(gzip_index.get(sidecar_path),
+                                         bustcode, sidecar_path)]
+
+    def _write(item):
+        sidecar_path, path, _ = item
+        return write_sidecar(path, sidecar_path, level)
+
+    if jobs <= 1 or len(pending) <= 1:
+        results = list(map(_write, pending))
+    else:
+        pool = ThreadPool(min(jobs, len(pending)))
+        try:
+            # zlib releases the GIL while compressing
+            results = pool.map(_write, pending)
+        finally:
+            pool.close()
+            pool.join()
+
+    written = []
+    for (sidecar_path, _, bustcode), compressed in zip(pending, results):
+        gzip_index[sidecar_path] = [bustcode, compressed]
+        if compressed:
+            written.append(sidecar_path)
+    return written
+
+
+def gzip_cfg_sidecars(cfg, sources, stats=None):
+    """Same as gzip_sidecars, for the sources which match the gzip
+    fileglobs of cfg"""
+    is_text = glob_matcher(cfg['gzip_fileglobs'])
+    sources = collections.OrderedDict(
+        (sidecar_path, source) for sidecar_path, source in sources.items()
+        if is_text(source[0]))
+
+    gzip_index = load_cfg_gzip_index(cfg)
+    with stats_stage(stats, 'compress'):
+        written = gzip_sidecars(sources, cfg['gzip_level'], cfg['jobs'],
+                                gzip_index)
+    save_cfg_gzip_index(cfg, gzip_index)
+    if stats is not None:
+        stats.counters['files_compressed'] += len(written)
+    return written
+
+
+# incremental updates
+#
+# A scan state keeps the parsed refs of each codefile and which codefiles
+# reference each static file, so that after a change only the changed
+# codefiles are parsed again and only the affected refs are busted again.
+# All paths in a scan state are normalized.
+
+
+def mk_path_matcher(rootdirs, file_filter=None, file_exclude=None):
+    """Predicate for paths that multi_iter_filepaths would yield"""
+    file_filter = glob_matcher(file_filter)
+    file_exclude = glob_matcher(file_exclude)
+
+    def _matcher(path):
+        for rootdir in rootdirs:
+            relpath = os.path.relpath(path, rootdir)
+            if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                continue
+
+            # match the path in the form it has when walking rootdir
+            path = os.path.join(rootdir, relpath)
+            if file_exclude and file_exclude(path):
+                continue
+
+            if not file_filter or file_filter(path):
+                return True
+        return False
+
+    return _matcher
+
+
+def mk_scan_state(cfg, parse_plain=True):
+    code_filepaths, static_filepaths = cfg_project_paths(cfg)
+    state = {
+        'cfg': cfg,
+        'parse_plain': parse_plain,
+        'is_codefile': mk_path_matcher(cfg['code_dirs'],
+                                       cfg['code_fileglobs'],
+                                       cfg_file_exclude(cfg)),
+        'is_static': mk_path_matcher(cfg['static_dirs'],
+                                     cfg['static_fileglobs'],
+                                     cfg_file_exclude(cfg)),
+        'static_paths': set(map(os.path.normpath, static_filepaths)),
+        'code_refs': collections.OrderedDict(),     # codepath -> refs
+        'ref_maps': collections.OrderedDict(),      # codepath -> ref_map
+        'dependents': collections.defaultdict(set), # static path -> codepaths
+        'parse_stats': mk_parse_stats(),
+    }
+    state['static_fn_dirs'] = mk_fn_dir_map(state['static_paths'])
+
+    parse_codefiles(state, map(os.path.normpath, code_filepaths))
+    for codepath in state['code_refs']:
+        resolve_codefile(state, codepath)
+    return state
+
+
+def parse_codefiles(state, codepaths):
+    cfg = state['cfg']
+    parsed = iter_parsed_codefiles(codepaths, state['parse_plain'],
+                                   cfg['file_encoding'], cfg['jobs'],
+                                   state['parse_stats'])
+    for codepath, records, error in parsed:
+        if error is not None:
+            print("omnibust: error reading '{0}' ('{1}')".format(codepath,
+                                                                  error))
+            records = []
+
+        code_dir, code_fn = os.path.split(codepath)
+        state['code_refs'][codepath] = [Ref(code_dir, code_fn, *record)
+                                        for record in records]
+
+
+def resolve_codefile(state, codepath):
+    """Update the ref map of a codefile, returns True if it changed"""
+    old_ref_map = state['ref_maps'].get(codepath, {})
+    ref_map = collections.OrderedDict(resolve_refs(
+        state['code_refs'][codepath], state['static_fn_dirs'],
+        state['cfg']['multibust'], state['cfg']['multibust_limit']))
+
+    for path in flatten(old_ref_map.values()):
+        state['dependents'][path].discard(codepath)
+    for path in flatten(ref_map.values()):
+        state['dependents'][path].add(codepath)
+
+    state['ref_maps'][codepath] = ref_map
+    return ref_map != old_ref_map
+
+
+def remove_codefile(state, codepath):
+    ref_map = state['ref_maps'].pop(codepath, {})
+    for path in flatten(ref_map.values()):
+        state['dependents'][path].discard(codepath)
+    state['code_refs'].pop(codepath, None)
+
+
+def iter_tracked_subpaths(state, dirpath):
+    prefix = os.path.join(dirpath, "")
+    for path in itertools.chain(state['static_paths'], state['code_refs']):
+        if path.startswith(prefix):
+            yield path
+
+
+def update_scan_state(state, changed_paths):
+    """Apply created, modified and deleted files to the scan state.
+
+    Returns the codepaths which have refs that may need to be busted.
+    """
+    changed_paths = set(map(os.path.normpath, changed_paths))
+    static_paths = state['static_paths']
+    for path in list(changed_paths):
+        if (path not in static_paths and path not in state['code_refs']
+                and not os.path.exists(path)):
+            # a removed or moved away directory, with all files in it
+            changed_paths.update(iter_tracked_subpaths(state, path))
+    static_paths_changed = False
+    dirty_codepaths = []
+
+    for path in sorted(changed_paths):
+        exists = os.path.isfile(path)
+        if state['is_static'](path) and exists != (path in static_paths):
+            static_paths_changed = True
+            if exists:
+                static_paths.add(path)
+            else:
+                static_paths.discard(path)
+
+        if not state['is_codefile'](path):
+            continue
+        if exists:
+            dirty_codepaths.append(path)
+        else:
+            remove_codefile(state, path)
+
+    parse_codefiles(state, dirty_codepaths)
+
+    affected = set(dirty_codepaths)
+    if static_paths_changed:
+        # new or deleted static files can change how any ref is resolved
+        state['static_fn_dirs'] = mk_fn_dir_map(static_paths)
+        for codepath in state['code_refs']:
+            if resolve_codefile(state, codepath):
+                affected.add(codepath)
+    else:
+        for codepath in dirty_codepaths:
+            resolve_codefile(state, codepath)
+
+    for path in changed_paths:
+        affected.update(state['dependents'].get(path, ()))
+    return affected
+
+
+def rewrite_scan_state(state, codepaths, target_reftype, buster,
+                       printer=ref_print_wrapper):
+    # a rewritten codefile may itself be a static file referenced elsewhere
+    affected = set()
+    stack = list(codepaths)
+    while stack:
+        codepath = stack.pop()
+        if codepath in affected or codepath not in state['ref_maps']:
+            continue
+        affected.add(codepath)
+        stack.extend(state['dependents'].get(codepath, ()))
+
+    file_ref_maps = collections.OrderedDict(
+        (codepath, ref_map) for codepath, ref_map in state['ref_maps'].items()
+        if codepath in affected
+    )
+    rewritten = rewrite_codefiles(file_ref_maps, target_reftype, buster,
+                                  state['cfg']['file_encoding'],
+                                  printer=printer)
+
+    # the parsed refs of rewritten files are outdated
+    parse_codefiles(state, rewritten)
+    for codepath in rewritten:
+        resolve_codefile(state, codepath)
+    return rewritten
+
+
+# project api
+#
+# Build tools and dev servers can keep a Project instead of running
+# omnibust as a command for every change. The config is read once, and
+# the scan state and the buster with its digests are kept between calls.
+
+
+class Project(object):
+    """A project directory with its config, scan state and buster.
+
+    args are the same as for the omnibust command, e.g. ['--no-init'] or
+    ['--filename']. Paths passed to and returned by the methods are
+    relative to root. Internally all paths are joined to root, the working
+    directory of the process is never changed.
+    """
+
+    def __init__(self, root=".", args=()):
+        self.root = os.path.abspath(root)
+        self.args = list(args)
+        self.target_reftype = get_target_reftype(self.args)
+        self.cfg = read_cfg(self.args, self.root)
+        self.buster = mk_cfg_buster(self.cfg)
+        self._state = None
+
+    def _abspath(self, path):
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    @property
+    def state(self):
+        """The scan state, the project is scanned on first use"""
+        if self._state is None:
+            self._state = mk_scan_state(self.cfg,
+                                        self.target_reftype is not None)
+        return self._state
+
+    @property
+    def ref_maps(self):
+        """codepath -> ref_map of the scan state, with absolute paths"""
+        return self.state['ref_maps']
+
+    def status(self):
+        """Returns (ref, paths, new_full_ref) for every ref that rewrite
+        would update"""
+        busted = []
+        for ref_map in self.state['ref_maps'].values():
+            for ref, paths, new_full_ref in iter_busted_refs(
+                    ref_map, self.target_reftype, self.buster):
+                ref = ref._replace(code_dir=self._relpath(ref.code_dir))
+                paths = [self._relpath(p) for p in paths]
+                busted.append((ref, paths, new_full_ref))
+        return busted
+
+    def rewrite(self, codepaths=None):
+        """Rewrite the refs of codepaths (default all codefiles), returns
+        the codepaths of the files which were rewritten. Nothing is
+        printed, status returns the refs that would be updated."""
+        state = self.state
+        if codepaths is None:
+            codepaths = list(state['ref_maps'])
+        else:
+            codepaths = [self._abspath(p) for p in codepaths]
+        # the host application decides what to print
+        rewritten = rewrite_scan_state(state, codepaths, self.target_reftype,
+                                       self.buster, printer=None)
+        save_cfg_buster(self.cfg, self.buster)
+        return [self._relpath(p) for p in rewritten]
+
+    def bust(self, paths):
+        """Bustcode of one or more static files"""
+        if isinstance(paths, (unicode, bytes)):
+            paths = [paths]
+        return self.buster([self._abspath(p) for p in paths])
+
+    def refresh(self, changed_paths=None):
+        """Apply created, modified and deleted files, or rescan the whole
+        project if changed_paths is None.
+
+        Returns the codepaths with refs that may need to be busted, which
+        can be passed on to rewrite.
+        """
+        if changed_paths is None:
+            self._state = None
+            return set(self._relpath(p) for p in self.ref_maps)
+
+        changed_paths = [self._abspath(p) for p in changed_paths]
+        self.buster.invalidate(changed_paths)
+        return set(self._relpath(p)
+                   for p in update_scan_state(self.state, changed_paths))
+
+
+# change detection
+#
+# Changes are detected with inotify where it is available (linux).
+# Otherwise the files and directories are polled with stat, where only
+# directories with a changed mtime are listed again.
+
+WATCH_POLL_INTERVAL = 0.5
+WATCH_DEBOUNCE = 0.05
+
+
+def iter_watch_dirs(rootdirs, dir_exclude=None):
+    dir_exclude = dir_glob_matcher(dir_exclude)
+    for rootdir in rootdirs:
+        for dirpath, dirnames, filenames in os.walk(rootdir):
+            if dir_exclude and dir_exclude(dirpath):
+                dirnames[:] = []
+                continue
+            yield os.path.normpath(dirpath), filenames
+
+
+def mk_poll_snapshot(rootdirs, dir_exclude=None):
+    snapshot = {'dir_exclude': dir_exclude, 'stats': {}}
+    add_poll_paths(snapshot, rootdirs)
+    return snapshot
+
+
+def add_poll_paths(snapshot, rootdirs):
+    """Add rootdirs recursively to snapshot, returns the added paths"""
+    stats = snapshot['stats']
+    added = []
+    for dirpath, filenames in iter_watch_dirs(rootdirs,
+                                              snapshot['dir_exclude']):
+        for path in [dirpath] + [os.path.join(dirpath, fn)
+                                 for fn in filenames]:
+            if path in stats:
+                continue
+            try:
+                stats[path] = stat_key(os.stat(path))
+                added.append(path)
+            except OSError:
+                pass
+    return added
+
+
+def poll_changes(snapshot):
+    """Stat all paths of snapshot, returns the paths that changed"""
+    stats = snapshot['stats']
+    changed = set()
+    for path, key in list(stats.items()):
+        try:
+            st = os.stat(path)
+        except OSError:
+            del stats[path]
+            changed.add(path)
+            continue
+
+        new_key = stat_key(st)
+        if new_key == key:
+            continue
+
+        stats[path] = new_key
+        if not os.path.isdir(path):
+            changed.add(path)
+            continue
+
+        # an entry of the directory was added or removed
+        for filename in os.listdir(path):
+            subpath = os.path.join(path, filename)
+            if subpath in stats:
+                continue
+            if os.path.isdir(subpath):
+                changed.update(add_poll_paths(snapshot, [subpath]))
+                continue
+            try:
+                stats[subpath] = stat_key(os.stat(subpath))
+                changed.add(subpath)
+            except OSError:
+                pass
+    return changed
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                IN_MOVED_TO | IN_CREATE | IN_DELETE)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def mk_inotify(rootdirs, dir_exclude=None):
+    """Returns an inotify handle, or None if inotify is not available"""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    inotify = {'fd': fd, 'libc': libc, 'wds': {}, 'dir_exclude': dir_exclude}
+    try:
+        add_inotify_watches(inotify, rootdirs)
+    except OSError:
+        # most likely fs.inotify.max_user_watches was reached
+        close_inotify(inotify)
+        return None
+    return inotify
+
+
+def add_inotify_watches(inotify, rootdirs):
+    """Watch rootdirs recursively, returns the files found in them"""
+    filepaths = []
+    watch_dirs = iter_watch_dirs(rootdirs, inotify['dir_exclude'])
+    for dirpath, filenames in watch_dirs:
+        encoded_path = dirpath.encode(sys.getfilesystemencoding())
+        wd = inotify['libc'].inotify_add_watch(inotify['fd'], encoded_path,
+                                               INOTIFY_MASK)
+        if wd < 0:
+            raise OSError("inotify_add_watch failed for '%s'" % dirpath)
+        inotify['wds'][wd] = dirpath
+        filepaths.extend(os.path.join(dirpath, fn) for fn in filenames)
+    return filepaths
+
+
+def remove_inotify_watches(inotify, dirpath):
+    prefix = os.path.join(dirpath, "")
+    for wd, path in list(inotify['wds'].items()):
+        if path == dirpath or path.startswith(prefix):
+            inotify['libc'].inotify_rm_watch(inotify['fd'], wd)
+            del inotify['wds'][wd]
+
+
+def close_inotify(inotify):
+    os.close(inotify['fd'])
+
+
+def read_inotify_changes(inotify, timeout=None):
+    """Wait for changes, returns the changed paths or None on overflow"""
+    fd = inotify['fd']
+    changed = set()
+    ready = select.select([fd], [], [], timeout)[0]
+    while ready:
+        data = os.read(fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+
+            dirpath = inotify['wds'].get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_IGNORED:
+                del inotify['wds'][wd]
+                continue
+
+            path = dirpath
+            if name:
+                name = name.decode(sys.getfilesystemencoding())
+                path = os.path.join(dirpath, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                changed.update(add_inotify_watches(inotify, [path]))
+            elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # watches follow the directory to where it was moved
+                remove_inotify_watches(inotify, path)
+            changed.add(path)
+
+        # collect a burst of events into a single update
+        ready = select.select([fd], [], [], WATCH_DEBOUNCE)[0]
+    return changed
+
+
+def iter_changes(rootdirs, dir_exclude=None):
+    """Yield sets of changed paths, or None if changes were lost"""
+    rootdirs = sorted(set(map(os.path.normpath, rootdirs)))
+    inotify = mk_inotify(rootdirs, dir_exclude)
+    if inotify is None:
+        snapshot = mk_poll_snapshot(rootdirs, dir_exclude)
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            changed = poll_changes(snapshot)
+            if changed:
+                yield changed
+        return
+
+    try:
+        while True:
+            changed = read_inotify_changes(inotify)
+            if changed is None or changed:
+                yield changed
+    finally:
+        close_inotify(inotify)
 
 # configuration
 
-def read_cfg(args):
+def read_cfg(args, root=None):
+    """If root is given, the config of the project in root is read and
+    its paths are joined to root, see root_cfg."""
     cfg = json.loads(strip_comments(DEFAULT_CFG))
+    cfg_path = os.path.join(root, ".omnibust") if root else ".omnibust"
 
-    if not get_flag(args, '--no-init') and not os.path.exists(".omnibust"):
-        raise PathError("try 'omnibust init'", ".omnibust")
+    if not get_flag(args, '--no-init') and not os.path.exists(cfg_path):
+        raise PathError("try 'omnibust init'", cfg_path)
         return None
 
-    if not get_flag(args, '--no-init'):
+    if get_flag(args, '--no-init'):
+        # without a project config there is no place for the caches
+        cfg['cache_file'] = None
+        cfg['ref_index_file'] = None
+        cfg['gzip_index_file'] = None
+    else:
         try:
-            with codecs.open(".omnibust", 'r', encoding='utf-8') as f:
+            with codecs.open(cfg_path, 'r', encoding='utf-8') as f:
                 cfg.update(json.loads(strip_comments(f.read())))
         except (ValueError, IOError) as e:
-            raise BaseError("Error parsing '%s', %s" % (".omnibust", e))
+            raise BaseError("Error parsing '%s', %s" % (cfg_path, e))
     
+    if get_flag(args, '--git'):
+        cfg['git'] = True
+    # the manifest isn't scanned, whichever command is run
+    cfg['manifest_file'] = get_opt(args, '--manifest', cfg['manifest_file'])
+
+    try:
+        cfg['jobs'] = int(get_opt(args, '--jobs', cfg['jobs']))
+    except (KeyError, ValueError):
+        raise BaseError("Invalid value for '--jobs', expected a number")
+
     if 'stat_length' not in cfg:
         cfg['stat_length'] = cfg['bust_length'] // 2
     if 'digest_length' not in cfg:
         cfg['digest_length'] = cfg['bust_length'] - cfg['stat_length']
 
+    if root:
+        cfg = root_cfg(cfg, root)
+    return cfg
+
+
+CFG_DIR_KEYS = ("static_dirs", "code_dirs")
+CFG_GLOB_KEYS = ("static_fileglobs", "code_fileglobs", "ignore_dirglobs",
+                 "gzip_fileglobs")
+CFG_FILE_KEYS = ("cache_file", "ref_index_file", "manifest_file",
+                 "gzip_index_file", "publish_dir")
+
+
+def glob_escape(path):
+    return re.sub(r"([*?[])", r"[\1]", path)
+
+
+def root_cfg(cfg, root):
+    """Copy of cfg with its paths and globs joined to root, so the project
+    in root is scanned with paths that don't depend on the working
+    directory."""
+    cfg = dict(cfg, root=root)
+    for key in CFG_DIR_KEYS:
+        cfg[key] = [os.path.normpath(os.path.join(root, path))
+                    for path in cfg[key]]
+    # globs are matched against whole paths, "*lib/*" must not match
+    # a lib directory above root
+    for key in CFG_GLOB_KEYS:
+        cfg[key] = [os.path.normpath(os.path.join(glob_escape(root), glob))
+                    for glob in cfg[key]]
+    for key in CFG_FILE_KEYS:
+        if cfg.get(key):
+            cfg[key] = os.path.join(root, cfg[key])
     return cfg
 
 
@@ -605,7 +2868,7 @@ CODE_FILETYPES = (
     ".py", ".rb", ".php", ".java", ".pl", ".cs", ".lua"
 )
 INIT_EXCLUDE_GLOBS = (
-    "*lib/*", "*lib64/*", ".git/*", ".hg/*", ".svn/*",
+    "*lib/*", "*lib64/*", "*.git/*", "*.hg/*", "*.svn/*",
 )
 
 DEFAULT_CFG = r"""
@@ -621,11 +2884,21 @@ DEFAULT_CFG = r"""
     "ignore_dirglobs": ["*.git/*", "*.hg/*", "*.svn/*", "*lib/*", "*lib64/*"],
 
     "multibust": {},
+    "multibust_limit": 1000,
 
-    // TODO: use file encoding parameter
     "file_encoding": "utf-8",
     "hash_function": "sha1",
-    "bust_length": 6
+    "bust_length": 6,
+
+    "cache_file": ".omnibust_cache",
+    "ref_index_file": ".omnibust_refs",
+    "manifest_file": "omnibust_manifest.json",
+    "publish_dir": null,
+    "gzip_level": 6,
+    "gzip_fileglobs": ["*.js", "*.css", "*.svg"],
+    "gzip_index_file": ".omnibust_gzip",
+    "git": false,
+    "jobs": 1
 }
 """ % (
    dumpslist(["*" + ft for ft in STATIC_FILETYPES]),
@@ -644,9 +2917,30 @@ INIT_CFG = r"""{
 
     "ignore_dirglobs": ["*.git/*", "*.hg/*", "*.svn/*", "*lib/*", "*lib64/*"]
 
-    // "file_encoding": "utf-8",     // for reading codefiles
-    // "hash_function": "sha1",      // sha1, sha256, sha512, crc32
-    // "bust_length": 6
+    // "file_encoding": "utf-8",            // for reading/writing codefiles
+    // "hash_function": "sha1",             // sha1, sha256, md5, crc32,
+                                            // adler32, blake2b, blake2s
+    // blake2b and blake2s take a digest size in bytes, e.g. "blake2b:16"
+    // "bust_length": 6,
+    // "jobs": 1,                           // parallel parsing and hashing
+    // "git": false,                        // list files and bust by git
+
+    // Digests of unchanged static files and refs of unchanged codefiles
+    // are reused from previous runs. Set to null to disable.
+    // "cache_file": ".omnibust_cache",
+    // "ref_index_file": ".omnibust_refs",
+
+    // Written by 'omnibust manifest', see omnibust.load_manifest
+    // "manifest_file": "omnibust_manifest.json",
+
+    // Where 'omnibust publish' creates busted filenames, null to create
+    // them next to the static files
+    // "publish_dir": null,
+
+    // Text files get .gz sidecars with --gzip, if that makes them smaller
+    // "gzip_level": 6,                     // zlib level 1-9
+    // "gzip_fileglobs": ["*.js", "*.css", "*.svg"],
+    // "gzip_index_file": ".omnibust_gzip",
 
     // Cachebust references which contain a multibust marker are
     // expanded using each of the replacements. The cachebust hash will
@@ -660,18 +2954,35 @@ INIT_CFG = r"""{
     // "multibust": {
     //    "{{ lang }}": ["en", "de"]  // marker: replacements
     // },
+
+    // Refs with several markers are expanded to every combination of
+    // their replacements, up to this many combinations.
+    // "multibust_limit": 1000,
 }
 """
 
 # option parsing
 
+COMMANDS = ("init", "status", "rewrite", "watch", "manifest", "publish")
+
 VALID_ARGS = set([
     "-h", "--help",
     "-q", "--quiet",
+    "-v", "--verbose",
     "--version",
     "--no-init",
     "--filename",
     "--querystring",
+    "--stats",
+    "--gzip",
+    "--git",
+])
+
+VALID_OPTS = set([
+    "--jobs",
+    "--manifest",
+    "--publish-dir",
+    "--stats-json",
 ])
 
 
@@ -685,13 +2996,18 @@ def validate_args(args):
 
     args = iter(args)
     cmd = next(args)
-    if cmd not in ("init", "status", "rewrite"):
+    if cmd not in COMMANDS:
         raise BaseError("Invalid command '%s' " % cmd)
         
     for arg in args:
         if arg in VALID_ARGS:
             continue
 
+        if arg.split("=")[0] in VALID_OPTS:
+            if "=" not in arg:
+                next(args, None)    # skip the value
+            continue
+
         raise BaseError("Invalid argument '%s' " % arg)
 
 
@@ -700,12 +3016,10 @@ def get_flag(args, flag):
 
 
 def get_command(args):
-    if len(args) == 0:
-        raise BaseError("Expected command (init|status|rewrite)")
+    if len(args) == 0 or args[0] not in COMMANDS:
+        raise BaseError("Expected command (%s)" % "|".join(COMMANDS))
 
     cmd = args[0]
-    if cmd not in ("init", "status", "rewrite"):
-        raise BaseError("Expected command (init|status|rewrite)")
 
     return cmd
 
@@ -765,39 +3079,182 @@ def init_project(args):
 
 
 def status(args, cfg):
+    # Refs are resolved, busted and printed one codefile at a time, so
+    # output starts right away and only the refs of one codefile are kept
+    # in memory.
     target_reftype = get_target_reftype(args)
-    ref_map = scan_project(args, cfg)
-    refs = list(ref_print_wrapper(busted_refs(ref_map, cfg, target_reftype)))
-    if not refs:
+    buster = mk_cfg_buster(cfg)
+    stats = RunStats()
+    pool = ThreadPool(cfg['jobs']) if cfg['jobs'] > 1 else None
+    found_refs = False
+    try:
+        file_ref_maps = iter_project_ref_maps(args, cfg, buster.stat_cache,
+                                              stats)
+        for _, ref_map in file_ref_maps:
+            refs = busted_refs(ref_map, cfg, target_reftype, buster, stats,
+                               pool)
+            for _ in ref_print_wrapper(refs):
+                found_refs = True
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    finish_run(args, cfg, buster, stats)
+    if not found_refs:
         print("omnibust: nothing to cachebust")
 
 
-
 def rewrite(args, cfg):
     target_reftype = get_target_reftype(args)
-    
-    # the loop is to deal with cascades
-    # it continues until all paths have been busted at least once
-    updated_paths = set()
-    while True:
-        ref_map = scan_project(args, cfg)
-        time.sleep(0.02)    # wait just a bit so that any rewrite will result
-                            # in a different timestamp on the next iteration
-        cur_paths = set()
-        refs = ref_print_wrapper(busted_refs(ref_map, cfg, target_reftype))
-        for ref, paths, new_full_ref in refs:
-            rewrite_content(ref, new_full_ref)
-            cur_paths.update(paths)
-
-        if len(cur_paths - updated_paths) == 0:
-            break
-
-        updated_paths.update(cur_paths)
-
-    if not updated_paths:
+    buster = mk_cfg_buster(cfg)
+    stats = RunStats()
+    ref_map = scan_project(args, cfg, buster.stat_cache, stats)
+
+    # Codefiles are rewritten in dependency order, so a css file is
+    # rewritten before the references to it are busted. Files which are
+    # not rewritten can be hashed up front.
+    file_ref_maps = group_ref_map(ref_map)
+    static_paths = flatten(ref_map.values())
+    with stats_stage(stats, 'hash'):
+        prehash_paths(buster, (p for p in static_paths
+                               if os.path.normpath(p) not in file_ref_maps),
+                      cfg['jobs'])
+
+    aliases = {}
+    for path in static_paths:
+        aliases.setdefault(os.path.normpath(path), set()).add(path)
+
+    rewritten = rewrite_codefiles(file_ref_maps, target_reftype, buster,
+                                  cfg['file_encoding'], aliases, stats)
+
+    if get_flag(args, '--gzip'):
+        sources = collections.OrderedDict()
+        for path in sorted(static_paths):
+            sidecar_path = os.path.normpath(path) + GZIP_EXT
+            if sidecar_path not in sources:
+                sources[sidecar_path] = (path, buster([path]))
+        compressed = gzip_cfg_sidecars(cfg, sources, stats)
+        if get_flag(args, '--verbose'):
+            for sidecar_path in compressed:
+                print("omnibust: compressed " + sidecar_path)
+
+    finish_run(args, cfg, buster, stats)
+    if not rewritten:
         print("omnibust: nothing to cachebust")
 
 
+def manifest(args, cfg):
+    manifest_path = get_opt(args, '--manifest', cfg['manifest_file'])
+    cfg = dict(cfg, manifest_file=manifest_path)
+    params = (cfg['hash_function'], cfg['digest_length'])
+    buster = mk_cfg_buster(cfg)
+    # digests kept in the manifest take precedence over the cache file
+    buster.digest_cache.update(load_cache(manifest_path,
+                                          manifest_params(*params)))
+    stats = RunStats()
+    ref_map = scan_project(args, cfg, buster.stat_cache, stats,
+                           parse_plain=True)
+
+    # every walked static file is in the stat cache
+    static_filepaths = list(buster.stat_cache)
+    with stats_stage(stats, 'hash'):
+        prehash_paths(buster, static_filepaths, cfg['jobs'])
+        urls = mk_manifest(ref_map, static_filepaths, buster)
+
+    digests = dict((p, buster.digest_cache[p]) for p in static_filepaths
+                   if p in buster.digest_cache)
+    try:
+        changed = dump_manifest(manifest_path, urls, digests, *params)
+    except (IOError, OSError) as e:
+        raise PathError("error writing manifest ({0})".format(e),
+                        manifest_path)
+
+    finish_run(args, cfg, buster, stats)
+    if changed:
+        print("omnibust: wrote {0} ({1} urls)".format(manifest_path,
+                                                       len(urls)))
+    else:
+        print("omnibust: {0} is up to date".format(manifest_path))
+
+
+def publish(args, cfg):
+    publish_dir = get_opt(args, '--publish-dir', cfg['publish_dir'])
+    buster = mk_cfg_buster(cfg)
+    stats = RunStats()
+    ref_map = scan_project(args, cfg, buster.stat_cache, stats,
+                           parse_plain=True)
+
+    static_filepaths = list(buster.stat_cache)
+    with stats_stage(stats, 'hash'):
+        prehash_paths(buster, static_filepaths, cfg['jobs'])
+        urls = mk_manifest(ref_map, static_filepaths, buster)
+
+    targets = mk_publish_targets(urls, publish_dir)
+    if publish_dir is None:
+        rootdirs = cfg['static_dirs']
+    else:
+        rootdirs = [publish_dir]
+    try:
+        created = publish_files(targets)
+        removed = remove_stale_files(targets, rootdirs,
+                                     cfg['ignore_dirglobs'], publish_dir)
+        if get_flag(args, '--gzip'):
+            compressed = gzip_cfg_sidecars(cfg, collections.OrderedDict(
+                (target + GZIP_EXT, source)
+                for target, source in targets.items()), stats)
+        else:
+            compressed = []
+    except (IOError, OSError) as e:
+        raise PathError("error publishing ({0})".format(e),
+                        getattr(e, 'filename', None) or publish_dir or ".")
+
+    if get_flag(args, '--verbose'):
+        for path in created:
+            print("omnibust: published " + path)
+        for path in removed:
+            print("omnibust: removed " + path)
+        for path in compressed:
+            print("omnibust: compressed " + path)
+    finish_run(args, cfg, buster, stats)
+    print("omnibust: published {0} new files, removed {1} stale files".format(
+        len(created), len(removed)))
+
+
+def watch(args, cfg):
+    target_reftype = get_target_reftype(args)
+    parse_plain = target_reftype is not None
+    buster = mk_cfg_buster(cfg)
+    state = mk_scan_state(cfg, parse_plain)
+    rewrite_scan_state(state, state['ref_maps'], target_reftype, buster)
+
+    print("omnibust: watching for changes (ctrl-c to stop)")
+    rootdirs = cfg['code_dirs'] + cfg['static_dirs']
+    try:
+        for changed_paths in iter_changes(rootdirs, cfg['ignore_dirglobs']):
+            try:
+                if changed_paths is None:
+                    state = mk_scan_state(cfg, parse_plain)
+                    affected = state['ref_maps']
+                else:
+                    affected = update_scan_state(state, changed_paths)
+
+                if affected:
+                    rewrite_scan_state(state, affected, target_reftype,
+                                       buster)
+            except (IOError, OSError) as e:
+                # e.g. a file which was removed again right away, the
+                # next change is applied as usual
+                print("omnibust: error applying changes ('{0}')".format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_cfg_buster(cfg, buster)
+        if get_flag(args, '--verbose'):
+            print_parse_stats(state['parse_stats'])
+            print_buster_stats(buster)
+
+
 def dispatch(args):
     cmd = get_command(args)
     if cmd  == 'init':
@@ -806,6 +3263,12 @@ def dispatch(args):
         return status(args, read_cfg(args))
     if cmd == 'rewrite':
         return rewrite(args, read_cfg(args))
+    if cmd == 'watch':
+        return watch(args, read_cfg(args))
+    if cmd == 'manifest':
+        return manifest(args, read_cfg(args))
+    if cmd == 'publish':
+        return publish(args, read_cfg(args))
 
 
 def main(args=sys.argv[1:]):
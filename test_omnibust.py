@@ -4,7 +4,11 @@ import os
 import sys
 import time
 import codecs
+import gzip
+import hashlib
+import json
 import tempfile
+import threading
 import omnibust as ob
 
 try:
@@ -57,6 +61,50 @@ def _mk_test_project():
     touch(os.path.join(subdir_b, "b.js"))
     return root
 
+def _mk_web_project():
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, "static", "css"))
+    os.makedirs(os.path.join(root, "static", "img"))
+    _write_tmp_file('<link href="/static/css/app.css?_cb_=x">\n'
+                    '<img src="/static/img/logo.png?_cb_=x">\n',
+                    os.path.join(root, "index.html"))
+    _write_tmp_file('body { background: url(/static/img/bg.png?_cb_=x); }',
+                    os.path.join(root, "static", "css", "app.css"))
+    _write_tmp_file("logo", os.path.join(root, "static", "img", "logo.png"))
+    _write_tmp_file("bg", os.path.join(root, "static", "img", "bg.png"))
+    return root
+
+
+def _assert_raises(exc_type, fn, *args):
+    try:
+        fn(*args)
+        assert False, "should have failed with " + exc_type.__name__
+    except exc_type:
+        pass
+
+
+def _u(s):
+    # u"" literals are a syntax error on python 3.2
+    return s.decode('unicode_escape') if isinstance(s, bytes) else s
+
+
+def _read_file(path):
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _run_in(root, fn, *args):
+    orig_cwd = os.getcwd()
+    orig_out = sys.stdout
+    sys.stdout = StringIO()
+    os.chdir(root)
+    try:
+        return fn(*args)
+    finally:
+        os.chdir(orig_cwd)
+        sys.stdout = orig_out
+
+
 expansions = {
     "${foo}": ["exp_a", "exp_b"],
     "{{bar}}": ["exp_c", "exp_d", "exp_e"]
@@ -115,6 +163,9 @@ def test_filestat():
     touch(path)
     assert stat != ob.filestat(path)
     assert ob.filestat(path) == ob.filestat(path)
+    assert len(stat) == 13
+    assert len(ob.filestat(path, length=30)) == 30
+    assert ob.filestat(path, length=3) == ob.filestat(path)[:3]
 
 
 def test_digest_data():
@@ -125,6 +176,30 @@ def test_digest_data():
     assert digest("test", 'sha1') == digest("test", 'sha1')
     assert digest("foo", 'sha1') != digest("bar", 'sha1')
     assert digest("test", 'sha1') != digest("test", 'md5')
+    assert digest("test", 'crc32') != digest("test", 'adler32')
+    for name in ('sha1:16', 'blake2b:x', 'blake2b:100'):
+        _assert_raises(ob.BaseError, digest, "test", name)
+    if not hasattr(hashlib, 'blake2b'):
+        # blake2 never falls back to another hash
+        _assert_raises(ob.BaseError, digest, "test", 'blake2b')
+        return
+    assert digest("test", 'blake2b') != digest("test", 'blake2b:16')
+    assert len(digest("test", 'blake2s:5')) == 8
+
+
+def test_digest_file():
+    content = "".join(unicode(i) for i in range(10000))
+    path = _write_tmp_file(content)
+    digesters = ['sha1', 'md5', 'crc32', 'adler32']
+    if hasattr(hashlib, 'blake2b'):
+        digesters.extend(['blake2b', 'blake2s:8'])
+    for digester in digesters:
+        digest = ob.digest_data(content, digester)
+        assert ob.digest_file(path, digester) == digest
+        assert ob.digest_file(path, digester, bufsize=7) == digest
+
+    path = _write_tmp_file("")
+    assert ob.digest_file(path) == ob.digest_data("")
 
 
 def test_buster():
@@ -169,6 +244,91 @@ def test_bust_paths():
     bustcode_6 = buster([path_a])
     assert bustcode_5 == bustcode_6
 
+    # combined busts don't depend on the order of the paths
+    assert buster([path_b, path_a]) == bustcode_4
+
+
+def test_buster_digest_cache():
+    path_a = _write_tmp_file("foo")
+    path_b = _write_tmp_file("bar")
+
+    digest_cache = {}
+    buster = ob.mk_buster('sha1', 3, 3, digest_cache)
+    bustcode_a = buster([path_a])
+    bustcode_b = buster([path_b])
+    assert buster.stats == {'hits': 0, 'misses': 2,
+                            'bytes_hashed': 6}
+    assert path_a in digest_cache
+    assert path_b in digest_cache
+
+    buster = ob.mk_buster('sha1', 3, 3, digest_cache)
+    assert buster([path_a]) == bustcode_a
+    assert buster([path_b]) == bustcode_b
+    assert buster.stats == {'hits': 2, 'misses': 0,
+                            'bytes_hashed': 0}
+
+    time.sleep(0.02)
+
+    open(path_a, 'w').write("baz")
+    buster = ob.mk_buster('sha1', 3, 3, digest_cache)
+    assert buster([path_a]) != bustcode_a
+    assert buster([path_b]) == bustcode_b
+    assert buster.stats == {'hits': 1, 'misses': 1,
+                            'bytes_hashed': 3}
+
+
+def test_bust_cache_roundtrip():
+    path = _write_tmp_file("foo")
+    _, cache_path = tempfile.mkstemp()
+
+    assert ob.load_bust_cache(cache_path, 'sha1', 3) == {}
+
+    buster = ob.mk_buster('sha1', 3, 3)
+    buster([path])
+    ob.dump_bust_cache(cache_path, buster.digest_cache, 'sha1', 3)
+
+    assert ob.load_bust_cache(cache_path, 'sha1', 3) == buster.digest_cache
+    assert ob.load_bust_cache(cache_path, 'md5', 3) == {}
+    assert ob.load_bust_cache(cache_path, 'sha1', 4) == {}
+
+
+def test_cfg_buster_cache_pruned():
+    root = _mk_web_project()
+    old_path = os.path.join(root, "static", "img", "old.png")
+    _write_tmp_file("old", old_path)
+    _write_tmp_file('<img src="/static/img/logo.png?_cb_=x">\n'
+                    '<img src="/static/img/old.png?_cb_=x">\n',
+                    os.path.join(root, "index.html"))
+    _run_in(root, ob.dispatch, ['init'])
+
+    def _cached_paths():
+        ob.dispatch(['status'])
+        cfg = ob.read_cfg([])
+        cache = ob.load_bust_cache(cfg['cache_file'], cfg['hash_function'],
+                                   cfg['digest_length'])
+        return set(map(os.path.normpath, cache))
+
+    assert "static/img/old.png" in _run_in(root, _cached_paths)
+    os.remove(old_path)
+    cached_paths = _run_in(root, _cached_paths)
+    assert "static/img/old.png" not in cached_paths
+    assert "static/img/logo.png" in cached_paths
+
+
+def test_prehash_paths():
+    paths = [_write_tmp_file(unicode(i)) for i in range(8)]
+
+    serial_buster = ob.mk_buster('sha1')
+    serial_codes = [serial_buster([p]) for p in paths]
+
+    buster = ob.mk_buster('sha1')
+    ob.prehash_paths(buster, paths + paths, 4)
+    assert buster.stats == {'hits': 0, 'misses': 8,
+                            'bytes_hashed': 8}
+    assert [buster([p]) for p in paths] == serial_codes
+    assert buster.stats == {'hits': 0, 'misses': 8,
+                            'bytes_hashed': 8}
+
 
 def test_glob_matcher():
     js_matcher = ob.glob_matcher("*.js")
@@ -184,6 +344,26 @@ def test_glob_matcher():
     assert not jpg_matcher("foo/bar.py")
 
 
+def test_glob_matcher_fnmatch_compat():
+    globs = ["*.js", "*lib/*", "foo?.[ch]", "*[!a-z].txt"]
+    matcher = ob.glob_matcher(globs)
+    paths = ["a.js", "a.jsx", "./lib/a.py", "./lib", "foo1.c", "foo12.c",
+             "foo1.h", "a1.txt", "ab.txt", "x/.git/y"]
+    for path in paths:
+        expected = any(ob.fnmatch.fnmatch(path, g) for g in globs)
+        assert matcher(path) == expected, path
+
+
+def test_dir_glob_matcher():
+    matcher = ob.dir_glob_matcher(["*.git/*", "*node_modules"])
+    assert matcher("./.git")
+    assert matcher("./.git/objects")
+    assert matcher("./web/node_modules")
+    assert not matcher("./static")
+    assert not matcher("./.gitignore")
+    assert ob.dir_glob_matcher(None) is None
+
+
 def test_filter_longest():
     elems = ["abcdefghij", "aabbccddeeffgghhii", "aabbccddeeeef"]
 
@@ -220,6 +400,30 @@ def test_closest_matching_path():
     assert path == "bar/static"
 
 
+def test_fn_dir_map_closest_dir():
+    dirpaths = ["foo/static/img", "foo/assets/img", "bar/static/img",
+                "bar/static", "img"]
+    fn_dir_map = ob.mk_fn_dir_map([d + "/logo.png" for d in dirpaths])
+    cases = [
+        ("foo", "/static/img"), ("bar", "/static/img"), ("bar", "/img/"),
+        ("foo/templates", "/assets/img"), ("bar", "/static"),
+        ("foo", "/unknown"),
+    ]
+    for code_dir, refdir in cases:
+        assert fn_dir_map.closest_dir(code_dir, refdir, "logo.png") == (
+            ob.closest_matching_path(code_dir, refdir, dirpaths))
+    # without any match, the first directory is used instead of ""
+    assert fn_dir_map.closest_dir("baz", "", "logo.png") == "foo/static/img"
+
+    assert ("foo", "/static/img", "logo.png") in fn_dir_map.memo
+    fn_dir_map.add("foo/static/img", "logo.png")
+    assert fn_dir_map.memo
+    fn_dir_map.add("baz/static/img", "logo.png")
+    assert not fn_dir_map.memo
+    assert fn_dir_map.closest_dir("baz", "/static/img", "logo.png") == (
+        "baz/static/img")
+
+
 def test_find_static_filepath():
     static_fn_dirs = ob.mk_fn_dir_map([
         "foo/assets/app.js",
@@ -270,6 +474,33 @@ def test_expand_path():
     assert "/static/bar_exp_d.js" in paths
     assert "/static/bar_exp_e.js" in paths
 
+    paths = ob.expand_path("/static/{{bar}}/foo_${foo}.js", expansions)
+    assert len(paths) == 7
+    assert "/static/exp_c/foo_exp_a.js" in paths
+    assert "/static/exp_e/foo_exp_b.js" in paths
+    assert not [p for p in paths if "exp_" in p and "{" in p]
+
+    paths = ob.expand_path("/static/{{bar}}/foo_${foo}.js", expansions, 4)
+    assert len(paths) == 5
+
+
+def test_find_expanded_filepaths():
+    static_fn_dirs = ob.mk_fn_dir_map([
+        "static/exp_c/foo_exp_a.js",
+        "static/exp_d/foo_exp_b.js",
+    ])
+    ref_path = "/static/{{bar}}/foo_${foo}.js"
+    paths = ob.find_expanded_filepaths(".", ref_path, static_fn_dirs,
+                                       expansions)
+    assert paths == ["static/exp_c/foo_exp_a.js", "static/exp_d/foo_exp_b.js"]
+    assert (".", ref_path) in static_fn_dirs.expansion_memo
+
+    # a new static file can change how refs are resolved
+    static_fn_dirs.add("static/exp_e", "foo_exp_a.js")
+    assert not static_fn_dirs.expansion_memo
+    assert len(ob.find_expanded_filepaths(".", ref_path, static_fn_dirs,
+                                          expansions)) == 3
+
 
 def test_ref_paths():
     ref = ob.Ref("foo/static", "test.html", 123,
@@ -404,8 +635,181 @@ def test_parse_content_refs():
     assert "xyz" in busts
 
 
+def test_parse_content_refs_offsets():
+    content = ('<img src="a.png"><img src="a.png">\r\n'
+               '<img src="b.png?_cb_=1">')
+    refs = ob.parse_content_refs(content)
+    assert len(refs) == 3
+    assert [r.lineno for r in refs] == [1, 1, 2]
+    for ref in refs:
+        assert content[ref.offset:].startswith(ref.full_ref)
+
+
+def test_parse_content_refs_linebreaks():
+    content = _u(
+        '<img src="/static/img/logo.png"><img src="data:image/png;AA==">\r\n'
+        '<script src="/static/js/app.js?_cb_=123"></script>\r'
+        'url(/static/css/a_cb_abc.css) url(b.png)\n\n'
+        '  "/assets/img/x.png?foo=1&_cb_=xyz" \u2028 <a href="c.png">\x0c'
+        ' src=d_cb_.png\x85href="e.png?a=b&\r\n_cb_=1"'
+    )
+    refs = ob.parse_content_refs(content)
+    assert [r.lineno for r in refs] == [1, 2, 3, 3, 5, 6, 7, 8]
+    assert [r.type for r in refs] == [1, 3, 2, 1, 3, 1, 2, 1]
+    refs = ob.parse_content_refs(content, parse_plain=False)
+    assert [r.lineno for r in refs] == [2, 3, 5, 7]
+
+
+def test_iter_ref_tokens():
+    # a ref is classified only once, querystring markers take precedence
+    content = '<script src="/js/app_cb_1.js?_cb_=2"></script>'
+    tokens = list(ob.iter_ref_tokens(content))
+    assert tokens == [('src="/js/app_cb_1.js?_cb_=2"', "/js/app_cb_1.js",
+                       "2", ob.QS_REF, 8)]
+
+    content = '<img src="a.png">\n<img src="b_cb_1.png">\n<a href="c.png">'
+    offsets = [t[4] for t in ob.iter_ref_tokens(content)]
+    assert offsets == sorted(offsets)
+    assert [t[1] for t in ob.iter_ref_tokens(content)] == [
+        "a.png", "b.png", "c.png"]
+    assert [t[1] for t in ob.iter_ref_tokens(content, False)] == ["b.png"]
+
+    # each url() of a minified line is a ref of its own
+    content = ('.a{background:url(/img/a.png?_cb_=1)}'
+               '.b{background:url(/img/b_cb_2.png)}.c{background:url(c.png)}')
+    assert [t[1:4] for t in ob.iter_ref_tokens(content)] == [
+        ("/img/a.png", "1", ob.QS_REF),
+        ("/img/b.png", "2", ob.FN_REF),
+        ("c.png", "", ob.PLAIN_REF),
+    ]
+
+
 def test_iter_refs():
-    pass # TODO
+    paths = [
+        _write_tmp_file('<img src="/static/img/logo_%d.png">\n'
+                        '<script src="/static/app.js?_cb_=%d"></script>' % (i, i))
+        for i in range(20)
+    ]
+    missing_path = paths[3] + ".missing"
+    paths.insert(5, missing_path)
+
+    refs = list(ob.iter_refs(paths))
+    assert len(refs) == 40
+    assert ob.ref_codepath(refs[0]) == paths[0]
+    assert refs[0].path == "/static/img/logo_0.png"
+    assert refs[1].bustcode == "0"
+    assert refs[1].lineno == 2
+    assert missing_path not in [ob.ref_codepath(r) for r in refs]
+
+    assert list(ob.iter_refs(paths, jobs=3)) == refs
+
+
+def test_has_ref_triggers():
+    assert ob.has_ref_triggers(b'<img src="a.png">')
+    assert ob.has_ref_triggers(b'"a_cb_1.png"', parse_plain=False)
+    assert not ob.has_ref_triggers(b'<img src="a.png">', parse_plain=False)
+    assert not ob.has_ref_triggers(b'import os\nprint(os.sep)\n')
+    assert not ob.has_ref_triggers(b'\x89PNG\x00\x00url(')
+
+    assert ob.is_ascii_compatible('utf-8')
+    assert not ob.is_ascii_compatible('utf-16')
+
+
+def test_parse_codefile_prefilter():
+    path_a = _write_tmp_file('import os\n')
+    path_b = _write_tmp_file('<img src="a.png">')
+    _, path_c = tempfile.mkstemp()
+    with open(path_c, 'wb') as f:
+        f.write(_u('<img src="b.png">').encode('utf-16'))
+    assert ob.parse_codefile(path_a) is None
+    assert ob.parse_codefile(path_b) == [
+        (1, 'src="a.png"', 'a.png', '', ob.PLAIN_REF, 5)]
+    # the prefilter only applies to ascii compatible encodings
+    assert len(ob.parse_codefile(path_c, encoding='utf-16')) == 1
+
+    parse_stats = ob.mk_parse_stats()
+    parsed = list(ob.iter_parsed_codefiles([path_a, path_b],
+                                           parse_stats=parse_stats))
+    assert parsed[0] == (path_a, [], None)
+    assert parse_stats == {'scanned': 1, 'skipped': 1,
+                           'bytes_read': 27}
+
+
+def test_iter_indexed_codefiles():
+    path_a = _write_tmp_file('<img src="a.png">')
+    path_b = _write_tmp_file('<img src="b.png?_cb_=1">')
+    path_c = _write_tmp_file('<img src="c.png">')
+    missing_path = path_a + ".missing"
+    paths = [path_a, missing_path, path_b]
+    _, index_path = tempfile.mkstemp()
+    params = ob.ref_index_params(True, 'utf-8')
+
+    def _indexed(paths, jobs=1, parse_stats=None):
+        ref_index = ob.RefIndex(index_path, params)
+        try:
+            return list(ob.iter_indexed_codefiles(
+                paths, ref_index, jobs=jobs, parse_stats=parse_stats))
+        finally:
+            ref_index.close(commit=True)
+
+    def _indexed_paths():
+        ref_index = ob.RefIndex(index_path, params)
+        ref_index.close()
+        return sorted(ref_index.keys)
+
+    assert _indexed(paths + [path_c]) == list(
+        ob.iter_parsed_codefiles(paths + [path_c]))
+    assert _indexed_paths() == sorted([path_a, path_b, path_c])
+
+    # unchanged files are not parsed again, codefiles which are no longer
+    # walked are dropped
+    parse_stats = ob.mk_parse_stats()
+    assert _indexed(paths, parse_stats=parse_stats) == list(
+        ob.iter_parsed_codefiles(paths))
+    assert parse_stats['scanned'] == 0
+    assert _indexed_paths() == sorted([path_a, path_b])
+
+    time.sleep(0.02)
+    _write_tmp_file('<img src="c.png?_cb_=2">', path_b)
+    parsed = _indexed(paths, jobs=2)
+    assert parsed[2][1][0][2] == "c.png"
+    assert _indexed(paths)[2] == parsed[2]
+
+    # a rewrite of the same size within the mtime resolution is detected
+    # by the new inode of the atomically written file
+    st = os.stat(path_b)
+    tmp_path = _write_tmp_file('<img src="c.png?_cb_=3">')
+    os.utime(tmp_path, (st.st_atime, st.st_mtime))
+    os.rename(tmp_path, path_b)
+    parsed = _indexed(paths)
+    assert parsed[2][1][0][3] == "3"
+
+    ref_index = ob.RefIndex(index_path, params)
+    refs = list(ob.iter_refs(paths, ref_index=ref_index))
+    ref_index.close()
+    assert refs == list(ob.iter_refs(paths))
+
+    # codefiles are checked as they are walked
+    walked = []
+
+    def _walk():
+        for path in paths:
+            walked.append(path)
+            yield path
+
+    ref_index = ob.RefIndex(index_path, params)
+    parsed = ob.iter_indexed_codefiles(_walk(), ref_index)
+    assert next(parsed)[0] == path_a
+    assert walked == [path_a]
+    assert len(list(parsed)) == 2
+    ref_index.close()
+
+    # an index with other params is not used
+    ref_index = ob.RefIndex(index_path, ob.ref_index_params(False, 'utf-8'))
+    ref_index.close()
+    assert ref_index.keys == {}
+    assert not [fn for fn in os.listdir(os.path.dirname(index_path))
+                if fn.startswith(os.path.basename(index_path) + ".")]
 
 
 def test_iter_filepaths():
@@ -418,6 +822,73 @@ def test_iter_filepaths():
     assert len(iterfp(root, file_exclude="*.js")) == 6
     assert len(iterfp(root, dir_filter="*subdir_a")) == 4
     assert len(iterfp(root, dir_filter="*subdir_a", file_filter="*.py")) == 2
+    assert len(iterfp(root, dir_exclude="*subdir_a/*")) == 6
+
+
+def test_iter_filepaths_pruning():
+    root = _mk_test_project()
+    os.makedirs(os.path.join(root, "subdir_a", "nested"))
+    touch(os.path.join(root, "subdir_a", "nested", "c.py"))
+
+    seen_dirs = []
+
+    def dir_exclude(path):
+        seen_dirs.append(path)
+        return path.endswith("subdir_a")
+
+    paths = list(ob.iter_filepaths(root, dir_exclude=dir_exclude))
+    assert len(paths) == 6
+    assert not [p for p in seen_dirs if "nested" in p]
+
+
+def test_iter_fileentries():
+    root = _mk_test_project()
+    os.makedirs(os.path.join(root, "subdir_a", "nested"))
+    touch(os.path.join(root, "subdir_a", "nested", "c.py"))
+
+    walked = [os.path.join(dirpath, fn)
+              for dirpath, _, filenames in os.walk(root)
+              for fn in filenames]
+    entries = list(ob.iter_fileentries(root))
+    assert [e.path for e in entries] == walked
+    assert entries[0].stat().st_size == os.stat(walked[0]).st_size
+
+    entry = ob.FileEntry(walked[0])
+    assert entry.stat() is entry.stat()
+
+
+def test_buster_stat_cache():
+    path = _write_tmp_file("foo")
+
+    class CountingEntry(ob.FileEntry):
+        calls = 0
+
+        def stat(self):
+            CountingEntry.calls += 1
+            return ob.FileEntry.stat(self)
+
+    stat_cache = {path: CountingEntry(path)}
+    buster = ob.mk_buster('sha1', 3, 3, stat_cache=stat_cache)
+    assert buster([path]) == ob.mk_buster('sha1', 3, 3)([path])
+    assert CountingEntry.calls == 1
+
+    buster.invalidate([path])
+    assert path not in stat_cache
+
+
+def test_cfg_project_paths():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+    stat_cache = {}
+
+    def _paths():
+        code_paths, static_paths = ob.cfg_project_paths(cfg, stat_cache)
+        return list(code_paths), list(static_paths)
+
+    code_paths, static_paths = _run_in(root, _paths)
+    assert sorted(code_paths) == ["./index.html", "./static/css/app.css"]
+    assert len(static_paths) == 3
+    assert sorted(stat_cache.keys()) == sorted(static_paths)
 
 
 def test_multi_iter_filepaths():
@@ -430,10 +901,6 @@ def test_init_project_paths():
     pass # TODO
 
 
-def test_cfg_project_paths():
-    pass # TODO
-
-
 def test_ref_print_wrapper():
     refs = [
         (ob.Ref("foo/static", "test.html", 123,
@@ -458,14 +925,696 @@ def test_ref_print_wrapper():
     assert "_cb_=test" in lines[2]
 
 
+def test_replace_refs():
+    content = ('<img src="a.png"><img src="a.png">\n'
+               '<img src="b.png?_cb_=1">')
+    refs = ob.parse_content_refs(content)
+    updates = [
+        (refs[2], 'src="b.png?_cb_=2"'),
+        (refs[0], 'src="a.png?_cb_=3"'),
+    ]
+    assert ob.replace_refs(content, updates) == (
+        '<img src="a.png?_cb_=3"><img src="a.png">\n'
+        '<img src="b.png?_cb_=2">')
+
+    # refs which no longer match the content are skipped
+    stale = refs[1]._replace(offset=refs[1].offset + 1)
+    assert ob.replace_refs(content, [(stale, "foo")]) == content
+
+
 def test_rewrite_content():
-    pass # TODO
+    path = _write_tmp_file('<img src="a.png"><img src="b.png">')
+    refs = list(ob.iter_refs([path]))
+    ob.rewrite_content(path, [(refs[0], 'src="a.png?_cb_=1"'),
+                              (refs[1], 'src="b.png?_cb_=2"')])
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        assert f.read() == ('<img src="a.png?_cb_=1">'
+                            '<img src="b.png?_cb_=2">')
+
+
+def test_rewrite_content_unchanged():
+    path = _write_tmp_file('<img src="a.png">')
+    os.utime(path, (0, 0))
+    ref = next(ob.iter_refs([path]))
+    assert not ob.rewrite_content(path, [(ref, ref.full_ref)])
+    assert os.path.getmtime(path) == 0
+
+
+def test_rewrite_content_symlink():
+    real_path = _write_tmp_file('<img src="a.png">')
+    link_path = real_path + ".link"
+    os.symlink(real_path, link_path)
+
+    ref = next(ob.iter_refs([link_path]))
+    assert ob.rewrite_content(link_path, [(ref, 'src="a.png?_cb_=1"')])
+    assert os.path.islink(link_path)
+    assert _read_file(real_path) == '<img src="a.png?_cb_=1">'
+
+
+def test_rewrite_content_encoding():
+    _, path = tempfile.mkstemp()
+    content = _u('\ufeff<p>\xe4</p>\r\n<img src="\xe4.png">\r\n')
+    with open(path, 'wb') as f:
+        f.write(content.encode('utf-16'))
+    os.chmod(path, 0o640)
+
+    ref = next(ob.iter_refs([path], encoding='utf-16'))
+    assert ob.rewrite_content(path, [(ref, _u('src="\xe4.png?_cb_=1"'))],
+                              encoding='utf-16')
+    with open(path, 'rb') as f:
+        assert f.read() == content.replace(
+            _u('\xe4.png'), _u('\xe4.png?_cb_=1')).encode('utf-16')
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert not [fn for fn in os.listdir(os.path.dirname(path))
+                if fn.startswith("." + os.path.basename(path))]
+
+
+def test_group_updates():
+    ref_a = p_ref._replace(code_fn="a.html")
+    ref_b = p_ref._replace(code_fn="b.html")
+    refs = [(ref_a, [], "a1"), (ref_b, [], "b1"), (ref_a, [], "a2")]
+    updates = ob.group_updates(refs)
+    assert list(updates.keys()) == ["foo/static/a.html", "foo/static/b.html"]
+    assert updates["foo/static/a.html"] == [(ref_a, "a1"), (ref_a, "a2")]
 
 
 def test_scan_project():
     pass # TODO
 
 
+def test_iter_scan_project():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+
+    def _scan():
+        paths = ob.cfg_project_paths(cfg)
+        code_paths, static_paths = list(paths[0]), list(paths[1])
+        file_ref_maps = list(ob.iter_scan_project(code_paths, static_paths))
+        return file_ref_maps, ob._scan_project(code_paths, static_paths)
+
+    file_ref_maps, ref_map = _run_in(root, _scan)
+    codepaths = [os.path.normpath(p) for p, _ in file_ref_maps]
+    assert codepaths == ["index.html", os.path.join("static", "css",
+                                                     "app.css")]
+    assert [len(m) for _, m in file_ref_maps] == [2, 1]
+
+    merged = ob.collections.OrderedDict()
+    for _, file_ref_map in file_ref_maps:
+        merged.update(file_ref_map)
+    assert merged == ref_map
+
+
+def test_status_streaming():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init', '--jobs=2'])
+
+    def _status():
+        ob.status(['status', '--no-init'], cfg)
+        return sys.stdout.getvalue()
+
+    lines = _run_in(root, _status).splitlines()
+    assert os.path.normpath(lines[0]) == "index.html"
+    assert len([l for l in lines if "->" in l]) == 3
+
+    # code_dirs written by init can overlap, codefiles are listed once
+    cfg['code_dirs'] = ["./static/css", "."]
+    lines = _run_in(root, _status).splitlines()
+    codepaths = [os.path.normpath(l) for l in lines if l.startswith(".")]
+    assert sorted(codepaths) == [
+        "index.html", os.path.join("static", "css", "app.css")]
+
+    # the second run reads the refs of unchanged codefiles from the index
+    cfg['ref_index_file'] = ".omnibust_refs"
+    output = _run_in(root, _status)
+    assert os.path.exists(os.path.join(root, ".omnibust_refs"))
+    assert _run_in(root, _status) == output
+
+
+def test_group_ref_map():
+    ref_a = p_ref._replace(code_dir="./foo", code_fn="a.html")
+    ref_b = p_ref._replace(code_dir="foo", code_fn="b.html")
+    ref_c = p_ref._replace(code_dir="foo", code_fn="a.html", lineno=7)
+    ref_map = ob.collections.OrderedDict([
+        (ref_a, ["a.png"]), (ref_b, ["b.png"]), (ref_c, ["c.png"])
+    ])
+    file_ref_maps = ob.group_ref_map(ref_map)
+    assert list(file_ref_maps.keys()) == ["foo/a.html", "foo/b.html"]
+    assert list(file_ref_maps["foo/a.html"].keys()) == [ref_a, ref_c]
+
+
+def test_mk_ref_graph():
+    html_ref = p_ref._replace(code_dir=".", code_fn="index.html")
+    css_ref = p_ref._replace(code_dir="static", code_fn="app.css")
+    ref_map = ob.collections.OrderedDict([
+        (html_ref, ["./static/app.css"]), (css_ref, ["static/bg.png"]),
+    ])
+    graph = ob.mk_ref_graph(ob.group_ref_map(ref_map))
+    assert graph == {"index.html": ["static/app.css"], "static/app.css": []}
+
+
+def test_toposort():
+    graph = ob.collections.OrderedDict([
+        ("index.html", ["app.css", "app.js"]),
+        ("app.js", []),
+        ("app.css", ["theme.css"]),
+        ("theme.css", []),
+    ])
+    order = ob.toposort(graph)
+    assert order == ["theme.css", "app.css", "app.js", "index.html"]
+
+    graph = ob.collections.OrderedDict([
+        ("a.css", ["b.css"]), ("b.css", ["a.css"]), ("c.html", ["a.css"]),
+    ])
+    orig_out = sys.stdout
+    tmp_out = sys.stdout = StringIO()
+    order = ob.toposort(graph)
+    sys.stdout = orig_out
+    assert order == ["b.css", "a.css", "c.html"]
+    assert "reference cycle" in tmp_out.getvalue()
+
+
+def test_rewrite_cascade():
+    root = _mk_web_project()
+    css_path = os.path.join(root, "static", "css", "app.css")
+    html_path = os.path.join(root, "index.html")
+    cfg = ob.read_cfg(['--no-init'])
+
+    _run_in(root, ob.rewrite, ['rewrite', '--no-init'], cfg)
+    css = _read_file(css_path)
+    html = _read_file(html_path)
+    assert "_cb_=x)" not in css
+    assert '_cb_=x"' not in html
+
+    # a second run finds that everything is up to date
+    def _busted():
+        ref_map = ob.scan_project(['status', '--no-init'], cfg)
+        return list(ob.busted_refs(ref_map, cfg, None))
+    assert _run_in(root, _busted) == []
+
+    # a change to the image cascades through the css to the html
+    time.sleep(0.02)
+    _write_tmp_file("new bg", os.path.join(root, "static", "img", "bg.png"))
+    _run_in(root, ob.rewrite, ['rewrite', '--no-init'], cfg)
+    assert _read_file(css_path) != css
+    new_html = _read_file(html_path)
+    assert new_html != html
+    assert new_html.splitlines()[1] == html.splitlines()[1]
+
+
+def test_run_stats():
+    stats = ob.RunStats()
+
+    def _slow_paths():
+        for path in ["a", "b"]:
+            time.sleep(0.01)
+            yield path
+
+    def _parse(paths):
+        for path in paths:
+            time.sleep(0.01)
+            yield path
+            yield path
+
+    paths = stats.timed_iter('walk', _slow_paths(), 'code_files')
+    refs = list(stats.timed_iter('parse', _parse(paths), 'refs_found'))
+    assert len(refs) == 4
+    assert stats.counters['code_files'] == 2
+    assert stats.counters['refs_found'] == 4
+    # parsing doesn't include the time spent walking
+    assert 0.015 < stats.timings['walk'] < 0.1
+    assert 0.015 < stats.timings['parse'] < 0.1
+
+    stats.finish()
+    data = stats.as_dict()
+    assert data['counters']['files_walked'] == 2
+    assert data['cache_hit_rate'] is None
+    assert data['wall_time'] >= stats.timings['walk'] + stats.timings['parse']
+    assert "refs found" in stats.format()
+
+    # stages of other threads don't end the stage of the main thread
+    stats = ob.RunStats()
+    paths = stats.timed_iter('walk', _slow_paths(), 'code_files')
+    with ob.stats_stage(stats, 'parse'):
+        thread = threading.Thread(target=list, args=(paths,))
+        thread.start()
+        thread.join()
+    assert stats.counters['code_files'] == 2
+    assert 0.015 < stats.timings['walk'] < 0.1
+    assert 0.015 < stats.timings['parse'] < 0.1
+
+
+def test_rewrite_stats():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+    _, stats_path = tempfile.mkstemp()
+    args = ['rewrite', '--no-init', '--stats', '--stats-json', stats_path]
+    ob.validate_args(args)
+    _run_in(root, ob.rewrite, args, cfg)
+
+    with open(stats_path) as f:
+        data = json.load(f)
+    counters = data['counters']
+    assert counters['refs_found'] == 3
+    assert counters['refs_resolved'] == 3
+    assert counters['files_rewritten'] == 2
+    assert counters['rewrite_passes'] == 1
+    assert counters['bytes_read'] > 0
+    assert counters['bytes_hashed'] > 0
+    assert set(data['timings']) == set(ob.RunStats.STAGES)
+
+
+def test_manifest():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+    manifest_path = os.path.join(root, "manifest.json")
+    args = ['manifest', '--no-init', '--manifest', manifest_path]
+    ob.validate_args(args)
+    _run_in(root, ob.manifest, args, cfg)
+
+    manifest = ob.load_manifest(manifest_path)
+    assert set(manifest) == set([
+        "static/css/app.css", "static/img/logo.png",
+        "static/img/bg.png", "/static/css/app.css", "/static/img/logo.png",
+        "/static/img/bg.png"
+    ])
+    entry = manifest["/static/img/logo.png"]
+    assert entry['paths'] == ["static/img/logo.png"]
+    assert entry['bustcode'] == manifest["static/img/logo.png"]['bustcode']
+    assert entry['filename'] == ("/static/img/logo_cb_" + entry['bustcode'] +
+                                 ".png")
+
+    qs_url = ob.busted_url(manifest, "/static/img/logo.png")
+    assert qs_url == "/static/img/logo.png?_cb_=" + entry['bustcode']
+    fn_url = ob.busted_url(manifest, "/static/img/logo.png", ob.FN_REF)
+    assert fn_url == entry['filename']
+    assert ob.busted_url(manifest, "/unknown.js") == "/unknown.js"
+
+    # unchanged files are not hashed again
+    mtime = os.path.getmtime(manifest_path)
+    hashed = []
+    orig_mk_buster = ob.mk_buster
+
+    def _mk_buster(*args, **kwargs):
+        buster = orig_mk_buster(*args, **kwargs)
+        hashed.append(buster.stats)
+        return buster
+
+    ob.mk_buster = _mk_buster
+    try:
+        out = _run_in(root, lambda: (ob.manifest(args, cfg),
+                                     sys.stdout.getvalue())[1])
+    finally:
+        ob.mk_buster = orig_mk_buster
+    assert "up to date" in out
+    assert hashed[0]['misses'] == 0
+    assert os.path.getmtime(manifest_path) == mtime
+
+
+def test_manifest_not_rewritten():
+    root = _mk_web_project()
+    manifest_path = os.path.join(root, "other.json")
+    _run_in(root, ob.dispatch, ['manifest', '--no-init',
+                                '--manifest=other.json'])
+    data = _read_file(manifest_path)
+    # init picks up other.json as a codefile
+    _run_in(root, ob.dispatch, ['init'])
+    assert "*.json" in _run_in(root, ob.read_cfg, [])['code_fileglobs']
+
+    _run_in(root, ob.dispatch, ['rewrite', '--querystring',
+                                '--manifest=other.json'])
+    assert _read_file(manifest_path) == data
+    assert "_cb_=x" not in _read_file(os.path.join(root, "index.html"))
+
+
+def test_unpublished_path():
+    assert ob.unpublished_path("static/app_cb_abc123.js") == "static/app.js"
+    assert ob.unpublished_path("app.min_cb_abc.js") == "app.min.js"
+    assert ob.unpublished_path("static/app.js") is None
+    assert ob.unpublished_path("static_cb_abc/app.js") is None
+
+
+def test_publish():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+    logo_path = os.path.join(root, "static", "img", "logo.png")
+    img_dir = os.path.dirname(logo_path)
+    _write_tmp_file("other", os.path.join(img_dir, "other.txt"))
+    _write_tmp_file("keep", os.path.join(img_dir, "other_cb_abc.txt"))
+
+    def _published(dirpath):
+        return sorted(fn for fn in os.listdir(dirpath) if "_cb_" in fn)
+
+    _run_in(root, ob.publish, ['publish', '--no-init'], cfg)
+    published = _published(img_dir)
+    assert len(published) == 3
+    logo_fn = [fn for fn in published if fn.startswith("logo_cb_")][0]
+    assert _read_file(os.path.join(img_dir, logo_fn)) == "logo"
+
+    # published files are not scanned as static files
+    ref_map = _run_in(root, ob.scan_project, ['status', '--no-init'], cfg)
+    assert not any("_cb_" in p for p in ob.flatten(ref_map.values()))
+
+    time.sleep(0.02)
+    _write_tmp_file("new logo", os.path.join(root, "logo.tmp"))
+    os.rename(os.path.join(root, "logo.tmp"), logo_path)
+    _run_in(root, ob.publish, ['publish', '--no-init'], cfg)
+    new_published = _published(img_dir)
+    assert len(new_published) == 3
+    assert logo_fn not in new_published
+    assert "other_cb_abc.txt" in new_published
+
+    out_dir = os.path.join(root, "out")
+    args = ['publish', '--no-init', '--publish-dir', out_dir]
+    ob.validate_args(args)
+    _run_in(root, ob.publish, args, cfg)
+    assert (_published(os.path.join(out_dir, "static", "img")) ==
+            [fn for fn in new_published if fn != "other_cb_abc.txt"])
+
+    # copies of deleted static files are removed
+    _write_tmp_file('body { }', os.path.join(root, "static", "css", "app.css"))
+    os.remove(os.path.join(img_dir, "bg.png"))
+    _run_in(root, ob.publish, ['publish', '--no-init'], cfg)
+    assert not any(fn.startswith("bg_cb_") for fn in _published(img_dir))
+    assert "other_cb_abc.txt" in _published(img_dir)
+    _run_in(root, ob.publish, args, cfg)
+    assert not any(fn.startswith("bg_cb_") for fn in
+                   _published(os.path.join(out_dir, "static", "img")))
+
+
+def test_gzip_sidecars():
+    root = tempfile.mkdtemp()
+    text_path = _write_tmp_file("body { color: red; }\n" * 100,
+                                os.path.join(root, "app.css"))
+    tiny_path = _write_tmp_file("a{}", os.path.join(root, "tiny.css"))
+    sources = {
+        text_path + ".gz": (text_path, "abc"),
+        tiny_path + ".gz": (tiny_path, "def"),
+    }
+
+    gzip_index = {}
+    written = ob.gzip_sidecars(sources, 9, 2, gzip_index)
+    assert written == [text_path + ".gz"]
+    assert not os.path.exists(tiny_path + ".gz")
+    with gzip.open(text_path + ".gz", 'rb') as f:
+        assert f.read().decode('utf-8') == _read_file(text_path)
+    assert gzip_index[tiny_path + ".gz"] == ["def", False]
+
+    # unchanged bustcodes are skipped, changed ones compressed again
+    assert ob.gzip_sidecars(sources, 9, 2, gzip_index) == []
+    sources[text_path + ".gz"] = (text_path, "xyz")
+    assert ob.gzip_sidecars(sources, 9, 1, gzip_index) == [text_path + ".gz"]
+    assert ob.gzip_file(text_path) == ob.gzip_file(text_path)
+
+
+def test_publish_gzip():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+    css_path = os.path.join(root, "static", "css", "app.css")
+    css_dir = os.path.dirname(css_path)
+    _write_tmp_file("body { color: red; }\n" * 100, css_path)
+
+    _run_in(root, ob.publish, ['publish', '--no-init', '--gzip'], cfg)
+    published = sorted(os.listdir(css_dir))
+    assert len(published) == 3
+    assert published[2] == published[1] + ".gz"
+
+    time.sleep(0.02)
+    _write_tmp_file("body { color: blue; }\n" * 100, os.path.join(root, "tmp"))
+    os.rename(os.path.join(root, "tmp"), css_path)
+    _run_in(root, ob.publish, ['publish', '--no-init', '--gzip'], cfg)
+    new_published = sorted(os.listdir(css_dir))
+    assert len(new_published) == 3
+    assert not set(published[1:]) & set(new_published)
+
+
+def test_rewrite_gzip():
+    root = _mk_web_project()
+    css_path = os.path.join(root, "static", "css", "app.css")
+    _write_tmp_file("body { background: url(/static/img/bg.png?_cb_=x); }\n"
+                    * 100, css_path)
+
+    _run_in(root, ob.dispatch, ['init'])
+    _run_in(root, ob.dispatch, ['rewrite', '--querystring', '--gzip'])
+    assert "_cb_=x" not in _read_file(css_path)
+    with gzip.open(css_path + ".gz", 'rb') as f:
+        assert f.read().decode('utf-8') == _read_file(css_path)
+    assert not os.path.exists(os.path.join(root, "index.html.gz"))
+
+
+def _mk_git_project():
+    root = _mk_web_project()
+    _write_tmp_file("static/img/bg.png\n", os.path.join(root, ".gitignore"))
+
+    def _git(*args):
+        ob.run_git("-c", "user.name=test", "-c", "user.email=test@test",
+                   *args)
+
+    _run_in(root, _git, "init", "-q")
+    _run_in(root, _git, "add", "-A")
+    _run_in(root, _git, "commit", "-q", "-m", "init")
+    return root
+
+
+def test_git_project_paths():
+    root = _mk_git_project()
+    cfg = ob.read_cfg(['--no-init', '--git'])
+    code_paths, static_paths = _run_in(
+        root, lambda: map(sorted, ob.cfg_project_paths(cfg)))
+    assert "./static/css/app.css" in static_paths
+    assert "./static/img/logo.png" in static_paths
+    assert "./static/img/bg.png" not in static_paths
+    assert "./index.html" in code_paths
+    assert not [p for p in code_paths + static_paths if ".git/" in p]
+
+
+def test_git_blob_ids():
+    root = _mk_git_project()
+    logo_path = os.path.join(root, "static", "img", "logo.png")
+    blob_ids = _run_in(root, ob.git_blob_ids)
+    assert blob_ids[os.path.join("static", "img", "logo.png")] == (
+        hashlib.sha1(b"blob 4\0logo").hexdigest())
+
+    buster = _run_in(root, ob.mk_cfg_buster,
+                     ob.read_cfg(['--no-init', '--git']))
+    bustcode = _run_in(root, buster, ["static/img/logo.png"])
+    assert bustcode == ob.blob_id_bust(blob_ids["static/img/logo.png"])[:6]
+    assert buster.stats['bytes_hashed'] == 0
+
+    # touched files keep their bustcode, changed files are hashed
+    time.sleep(0.02)
+    touch(logo_path)
+    buster = _run_in(root, ob.mk_cfg_buster,
+                     ob.read_cfg(['--no-init', '--git']))
+    assert _run_in(root, buster, ["static/img/logo.png"]) == bustcode
+
+    _write_tmp_file("new logo", logo_path)
+    assert "static/img/logo.png" not in _run_in(root, ob.git_blob_ids)
+    buster = _run_in(root, ob.mk_cfg_buster,
+                     ob.read_cfg(['--no-init', '--git']))
+    assert _run_in(root, buster, ["static/img/logo.png"]) != bustcode
+    assert buster.stats['bytes_hashed'] == len("new logo")
+
+
+def test_mk_path_matcher():
+    is_css = ob.mk_path_matcher([".", "assets"], ["*.css"], ["*.git/*"])
+    assert is_css("static/app.css")
+    assert is_css("./static/app.css")
+    assert not is_css("static/app.js")
+    assert not is_css(".git/app.css")
+    assert not is_css("../app.css")
+
+    is_css = ob.mk_path_matcher(["assets"], ["*.css"])
+    assert is_css("assets/app.css")
+    assert not is_css("static/app.css")
+
+
+def test_update_scan_state():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+
+    def _update(changed_paths):
+        return _run_in(root, ob.update_scan_state, state, changed_paths)
+
+    state = _run_in(root, ob.mk_scan_state, cfg)
+    assert list(state['ref_maps'].keys()) == ["index.html", "static/css/app.css"]
+    assert state['dependents']["static/css/app.css"] == set(["index.html"])
+    assert state['dependents']["static/img/bg.png"] == set(["static/css/app.css"])
+
+    assert _update(["static/img/bg.png"]) == set(["static/css/app.css"])
+    assert _update(["./static/css/app.css"]) == set(["index.html",
+                                                     "static/css/app.css"])
+    assert _update(["README"]) == set()
+
+    # a new codefile
+    _write_tmp_file('<img src="/static/img/logo.png">',
+                    os.path.join(root, "about.html"))
+    assert _update(["about.html"]) == set(["about.html"])
+    assert len(state['ref_maps']["about.html"]) == 1
+
+    # a new static file that resolves a previously unknown ref
+    _write_tmp_file('<img src="/static/img/new.png">',
+                    os.path.join(root, "about.html"))
+    assert _update(["about.html"]) == set(["about.html"])
+    assert len(state['ref_maps']["about.html"]) == 0
+    _write_tmp_file("new", os.path.join(root, "static", "img", "new.png"))
+    assert _update(["static/img/new.png"]) == set(["about.html"])
+    assert len(state['ref_maps']["about.html"]) == 1
+
+    # deleted files
+    os.remove(os.path.join(root, "about.html"))
+    os.remove(os.path.join(root, "static", "img", "new.png"))
+    assert _update(["about.html", "static/img/new.png"]) == set()
+    assert "about.html" not in state['ref_maps']
+    assert not state['dependents']["static/img/new.png"]
+
+    # a directory moved out of the project, with the files in it
+    os.rename(os.path.join(root, "static", "img"),
+              os.path.join(root, "img.moved"))
+    assert _update(["static/img"]) == set(["index.html",
+                                           "static/css/app.css"])
+    assert not [p for p in state['static_paths'] if "img" in p]
+    assert list(state['ref_maps']["index.html"].values()) == [
+        ["static/css/app.css"]]
+
+
+def test_rewrite_scan_state():
+    root = _mk_web_project()
+    cfg = ob.read_cfg(['--no-init'])
+    buster = ob.mk_cfg_buster(cfg)
+    html_path = os.path.join(root, "index.html")
+    state = _run_in(root, ob.mk_scan_state, cfg)
+    _run_in(root, ob.rewrite_scan_state, state, state['ref_maps'], None, buster)
+    html = _read_file(html_path)
+    assert '_cb_=x"' not in html
+
+    time.sleep(0.02)
+    _write_tmp_file("new bg", os.path.join(root, "static", "img", "bg.png"))
+    affected = _run_in(root, ob.update_scan_state, state, ["static/img/bg.png"])
+    _run_in(root, ob.rewrite_scan_state, state, affected, None, buster)
+    # the rewritten css cascades to the html
+    assert _read_file(html_path) != html
+
+
+def test_project():
+    root = _mk_web_project()
+    html_path = os.path.join(root, "index.html")
+    logo_path = os.path.join(root, "static", "img", "logo.png")
+    project = ob.Project(root, ['--no-init'])
+
+    assert len(project.status()) == 3
+    rewritten, out = _run_in(root, lambda: (project.rewrite(),
+                                            sys.stdout.getvalue()))
+    assert sorted(rewritten) == ["index.html", "static/css/app.css"]
+    assert out == ""
+    assert project.status() == []
+    logo_bustcode = project.bust("static/img/logo.png")
+    assert "logo.png?_cb_=" + logo_bustcode in _read_file(html_path)
+
+    time.sleep(0.02)
+    _write_tmp_file("new logo", os.path.join(root, "logo.tmp"))
+    os.rename(os.path.join(root, "logo.tmp"), logo_path)
+    affected = project.refresh(["static/img/logo.png"])
+    assert affected == set(["index.html"])
+    assert [ref.path for ref, _, _ in project.status()] == [
+        "/static/img/logo.png"]
+    assert project.rewrite(affected) == ["index.html"]
+    assert project.bust(["static/img/logo.png"]) != logo_bustcode
+    assert project.status() == []
+
+    # refresh without paths scans the project again
+    assert project.refresh() == set(["index.html", "static/css/app.css"])
+
+
+def test_project_cwd():
+    # "*lib/*" of ignore_dirglobs must not match the directory of root
+    root = os.path.join(tempfile.mkdtemp(), "lib", "project")
+    os.makedirs(os.path.dirname(root))
+    os.rename(_mk_web_project(), root)
+    _run_in(root, ob.dispatch, ['init'])
+
+    def _chdir(path):
+        raise AssertionError("working directory changed")
+
+    orig_chdir = os.chdir
+    os.chdir = _chdir
+    try:
+        project = ob.Project(root)
+        assert len(project.status()) == 3
+        assert sorted(project.rewrite()) == ["index.html",
+                                             "static/css/app.css"]
+        assert project.refresh(["static/img/logo.png"]) == set(
+            ["index.html"])
+    finally:
+        os.chdir = orig_chdir
+    assert os.path.exists(os.path.join(root, ".omnibust_cache"))
+
+
+def test_poll_changes():
+    root = _mk_test_project()
+    snapshot = ob.mk_poll_snapshot([root], "*subdir_b/*")
+    assert ob.poll_changes(snapshot) == set()
+
+    time.sleep(0.02)
+    _write_tmp_file("changed", os.path.join(root, "foo.js"))
+    _write_tmp_file("new", os.path.join(root, "subdir_a", "new.py"))
+    _write_tmp_file("ignored", os.path.join(root, "subdir_b", "new.js"))
+    os.makedirs(os.path.join(root, "subdir_c"))
+    _write_tmp_file("new", os.path.join(root, "subdir_c", "c.js"))
+    os.remove(os.path.join(root, "bar.js"))
+
+    changed = ob.poll_changes(snapshot)
+    assert os.path.join(root, "foo.js") in changed
+    assert os.path.join(root, "bar.js") in changed
+    assert os.path.join(root, "subdir_a", "new.py") in changed
+    assert os.path.join(root, "subdir_c", "c.js") in changed
+    assert os.path.join(root, "subdir_b", "new.js") not in changed
+    assert ob.poll_changes(snapshot) == set()
+
+
+def test_read_inotify_changes():
+    root = _mk_test_project()
+    inotify = ob.mk_inotify([root])
+    if inotify is None:
+        return  # not available on this platform
+
+    try:
+        assert ob.read_inotify_changes(inotify, 0) == set()
+        _write_tmp_file("changed", os.path.join(root, "foo.js"))
+        os.makedirs(os.path.join(root, "subdir_c"))
+        _write_tmp_file("new", os.path.join(root, "subdir_c", "c.js"))
+        changed = ob.read_inotify_changes(inotify, 1)
+        assert os.path.join(root, "foo.js") in changed
+        assert os.path.join(root, "subdir_c") in changed
+
+        _write_tmp_file("new", os.path.join(root, "subdir_c", "d.js"))
+        changed = ob.read_inotify_changes(inotify, 1)
+        assert os.path.join(root, "subdir_c", "d.js") in changed
+
+        # a moved away directory is no longer watched
+        os.rename(os.path.join(root, "subdir_c"), root + ".moved")
+        changed = ob.read_inotify_changes(inotify, 1)
+        assert os.path.join(root, "subdir_c") in changed
+        _write_tmp_file("new", os.path.join(root + ".moved", "e.js"))
+        assert ob.read_inotify_changes(inotify, 0.1) == set()
+    finally:
+        ob.close_inotify(inotify)
+
+
+def test_main_errors():
+    def _main(args):
+        assert ob.main(args) == 1
+        return sys.stdout.getvalue()
+
+    root = tempfile.mkdtemp()
+    out = _run_in(root, _main, ['status', '--no-init', '--jobs=x'])
+    assert out.startswith("omnibust: Invalid value for '--jobs'")
+    out = _run_in(root, _main, ['status', '--no-init', '--git'])
+    assert out.startswith("omnibust: ")
+    assert "Traceback" not in out
+    out = _run_in(root, _main, ['status'])
+    assert out.startswith("omnibust: path error")
+
+
 def test_read_cfg():
     cfg = ob.read_cfg(['--no-init'])
 
@@ -478,6 +1627,27 @@ def test_read_cfg():
     assert isinstance(cfg['digest_length'], int)
 
 
+def test_read_cfg_jobs():
+    assert ob.read_cfg(['--no-init'])['jobs'] == 1
+    assert ob.read_cfg(['--no-init', '--jobs=4'])['jobs'] == 4
+    assert ob.read_cfg(['--no-init', '--jobs', '3'])['jobs'] == 3
+    try:
+        ob.read_cfg(['--no-init', '--jobs=many'])
+        assert False, "expected BaseError because of invalid --jobs"
+    except ob.BaseError:
+        pass
+
+
+def test_validate_args():
+    ob.validate_args(["status", "--no-init", "--jobs=4"])
+    ob.validate_args(["rewrite", "--jobs", "4", "--querystring"])
+    try:
+        ob.validate_args(["status", "--foo"])
+        assert False, "expected BaseError because of invalid argument"
+    except ob.BaseError:
+        pass
+
+
 def test_dumplist():
     assert ob.dumpslist(["foo", "bar", "baz"]) == """[
         "foo", 